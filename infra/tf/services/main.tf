@@ -37,6 +37,23 @@ resource "azurerm_storage_blob" "model" {
   source                 = "../../../src/azurite_populate/flowers_1.keras"
 }
 
+# Manifest that points to the latest model (the modeller overwrites it after each retrain)
+resource "azurerm_storage_blob" "model_manifest" {
+  name                   = "models/latest.json"
+  storage_account_name   = azurerm_storage_account.olearn.name
+  storage_container_name = azurerm_storage_container.olearn.name
+  type                   = "Block"
+  content_type           = "application/json"
+  source_content = jsonencode({
+    version   = 1
+    blob_name = azurerm_storage_blob.model.name
+  })
+
+  lifecycle {
+    ignore_changes = [source_content]
+  }
+}
+
 # Upload validation data
 resource "azurerm_storage_blob" "val_data" {
   name                   = "datasets/val_data.zip"
@@ -66,7 +83,7 @@ resource "azurerm_container_group" "olearn" {
   sku                         = "Standard"
   dns_name_label_reuse_policy = "ResourceGroupReuse"
 
-  depends_on = [azurerm_storage_blob.model, azurerm_storage_blob.val_data]
+  depends_on = [azurerm_storage_blob.model, azurerm_storage_blob.model_manifest, azurerm_storage_blob.val_data]
 
   identity {
     type = "SystemAssigned"
@@ -108,6 +125,29 @@ resource "azurerm_container_group" "olearn" {
       protocol = "TCP"
     }
 
+    # Traffic is only sent once the model is loaded and warmed up
+    readiness_probe {
+      http_get {
+        path   = "/ready"
+        port   = 8888
+        scheme = "Http"
+      }
+      initial_delay_seconds = 10
+      period_seconds        = 5
+      failure_threshold     = 3
+    }
+
+    liveness_probe {
+      http_get {
+        path   = "/health"
+        port   = 8888
+        scheme = "Http"
+      }
+      initial_delay_seconds = 30
+      period_seconds        = 10
+      failure_threshold     = 3
+    }
+
     environment_variables = {
       USE_AZURE_CREDENTIAL = var.use_azure_credential
       STORAGE_ACCOUNT_NAME = azurerm_storage_account.olearn.name
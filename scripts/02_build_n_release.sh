@@ -25,8 +25,8 @@ cd $PROJECT_DIR/infra/tf/container_registry
 ACR=$(terraform output -raw registry_name)
 
 
-# Change to build directory
-cd $PROJECT_DIR/src/$1
+# Build from src/ so the image can include the shared modules in src/common
+cd $PROJECT_DIR/src
 
 # Build the image
-az acr build --registry $ACR --image $1:$IMAGE_VERSION --file $PROJECT_DIR/src/$1/Dockerfile  .
+az acr build --registry $ACR --image $1:$IMAGE_VERSION --file $1/Dockerfile  .
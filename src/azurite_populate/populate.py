@@ -1,12 +1,10 @@
 import os
+import json
 import logging
 
-from azure.storage.blob import BlobServiceClient
-from azure.storage.queue import QueueServiceClient
 from azure.core.exceptions import ResourceExistsError
 
-# Decide if we're running in the cloud or locally
-CLOUD = os.environ.get("USE_AZURE_CREDENTIAL", "false").lower() == "true"
+from storage import get_blob_service_client, get_queue_service_client, upload_file, upload_bytes
 
 # Set the logging level for this script
 logging.basicConfig(level=logging.INFO)
@@ -15,57 +13,27 @@ logging.basicConfig(level=logging.INFO)
 azure_logger = logging.getLogger('azure')
 azure_logger.setLevel(logging.WARNING)
 
-def get_blob_service_client():
-    """
-    The STORAGE_CONNECTION_STRING is only set up when running in the cloud. 
-    If it's not set, we're running locally with Azurite.
-    """
-    if CLOUD:
-        from azure.identity import DefaultAzureCredential # type: ignore
-        credential = DefaultAzureCredential()
-        account_url = os.environ["STORAGE_BLOB_URL"]
-        return BlobServiceClient(account_url=account_url, credential=credential)
-    else:
-        return BlobServiceClient.from_connection_string(os.environ["STORAGE_CONNECTION_STRING"])
-
-def get_queue_service_client():
-    """
-    The STORAGE_CONNECTION_STRING is only set up when running in the cloud. 
-    If it's not set, we're running locally with Azurite.
-    """
-    if CLOUD:
-        from azure.identity import DefaultAzureCredential # type: ignore
-        credential = DefaultAzureCredential()
-        account_url = os.environ["STORAGE_QUEUE_URL"]
-        return QueueServiceClient(account_url=account_url, credential=credential)
-    else:
-        return QueueServiceClient.from_connection_string(os.environ["STORAGE_CONNECTION_STRING"])
-    
 if __name__ == "__main__":
 
     # Having any of these missign should raise an exception
     STORAGE_CONTAINER = os.environ["STORAGE_CONTAINER"]
     STORAGE_QUEUE = os.environ["STORAGE_QUEUE"]
 
-    with get_blob_service_client() as blob_service_client:
-
-        # Create the storage container if it doesn't exist
-        try:
-            blob_service_client.create_container(STORAGE_CONTAINER)
-        except ResourceExistsError:
-            print(f"Container {STORAGE_CONTAINER} already exists.")
-        else:
-            print(f"Container {STORAGE_CONTAINER} created.")
-
-    with get_queue_service_client() as queue_service_client:
+    # Create the storage container if it doesn't exist
+    try:
+        get_blob_service_client().create_container(STORAGE_CONTAINER)
+    except ResourceExistsError:
+        print(f"Container {STORAGE_CONTAINER} already exists.")
+    else:
+        print(f"Container {STORAGE_CONTAINER} created.")
 
-        # Create the storage queue if it doesn't exist
-        try:
-            queue_service_client.create_queue(STORAGE_QUEUE)
-        except ResourceExistsError:
-            print(f"Queue {STORAGE_QUEUE} already exists.")
-        else:
-            print(f"Queue {STORAGE_QUEUE} created.")
+    # Create the storage queue if it doesn't exist
+    try:
+        get_queue_service_client().create_queue(STORAGE_QUEUE)
+    except ResourceExistsError:
+        print(f"Queue {STORAGE_QUEUE} already exists.")
+    else:
+        print(f"Queue {STORAGE_QUEUE} created.")
 
     # Upload following files to the storage container
     files = [
@@ -73,9 +41,22 @@ if __name__ == "__main__":
         ("datasets/", "val_data.zip"),
     ]
 
-    with get_blob_service_client() as blob_service_client:
-        for prefix, file in files:
-            with open(file, "rb") as data:
-                blob_client = blob_service_client.get_blob_client(STORAGE_CONTAINER, prefix + file)
-                blob_client.upload_blob(data, overwrite=True)
-                logging.info(f"Uploaded {prefix + file} to {STORAGE_CONTAINER}.")
\ No newline at end of file
+    for prefix, file in files:
+        result = upload_file(prefix + file, file)
+        logging.info(f"Uploaded {prefix + file} to {STORAGE_CONTAINER}.")
+
+        # Point the model manifest to the base model, unless the modeller has already published one
+        if prefix == "models/":
+            manifest = {
+                "version": 1,
+                "blob_name": prefix + file,
+                "etag": result["etag"],
+                "size": os.path.getsize(file),
+            }
+            try:
+                upload_bytes("models/latest.json", json.dumps(manifest).encode(), content_type="application/json",
+                             overwrite=False)
+            except ResourceExistsError:
+                logging.info("models/latest.json already exists, keeping it.")
+            else:
+                logging.info(f"Uploaded models/latest.json to {STORAGE_CONTAINER}.")
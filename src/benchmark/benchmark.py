@@ -0,0 +1,304 @@
+"""
+Load test for the flowerpredict service.
+
+Starts flowerpredict against Azurite, seeds it with a model like
+azurite_populate/populate.py does, sends concurrent /predict requests and
+writes the results as JSON. Start Azurite first:
+
+    docker compose up -d azurite
+    python benchmark.py --concurrency 1 4 16 --image-sizes 224x224 1024x768 4000x3000
+
+With --storage-backend local no storage service is needed, the model is
+kept in a local directory.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import random
+import logging
+import argparse
+import platform
+import subprocess
+import threading
+
+import numpy as np
+import requests
+
+from io import BytesIO
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from azure.core.exceptions import ResourceExistsError
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PREDICT_DIR = os.path.join(HERE, "..", "flowerpredict")
+# Shared storage module, copied next to the services in their Docker images
+COMMON_DIR = os.path.join(HERE, "..", "common")
+
+# Same account key as Azurite uses in docker-compose, exposed on localhost
+AZURITE_CONNECTION_STRING = (
+    "DefaultEndpointsProtocol=http;AccountName=devstoreaccount1;"
+    "AccountKey=Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw==;"
+    "BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;QueueEndpoint=http://127.0.0.1:10001/devstoreaccount1;"
+)
+
+logging.basicConfig(level=logging.INFO)
+logging.getLogger("azure").setLevel(logging.WARNING)
+
+
+def parse_size(text: str):
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+def make_jpeg(width: int, height: int, seed: int) -> bytes:
+    """
+    Synthetic photo-like JPEG: a smooth gradient with some noise, so the
+    file size is closer to a real photo than a flat colour would be.
+    """
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    base = np.stack([np.broadcast_to(x, (height, width)), np.broadcast_to(y, (height, width)),
+                     np.full((height, width), rng.integers(0, 255), dtype=np.float32)], axis=-1)
+    noise = rng.normal(0, 20, size=(height, width, 3))
+    image = Image.fromarray(np.clip(base + noise, 0, 255).astype(np.uint8))
+    with BytesIO() as data:
+        image.save(data, format="JPEG", quality=90)
+        return data.getvalue()
+
+
+def seed_storage(env: dict, model_file: str):
+    """Create the container and upload the model and its manifest, like populate.py."""
+    # The storage module reads its settings on import, so use the same environment as the server
+    os.environ.update(env)
+    sys.path.insert(0, COMMON_DIR)
+    import storage
+
+    container = env["STORAGE_CONTAINER"]
+    try:
+        storage.get_blob_service_client().create_container(container)
+    except ResourceExistsError:
+        pass
+    result = storage.upload_file("models/flowers_1.keras", model_file)
+    manifest = {"version": 1, "blob_name": "models/flowers_1.keras", "etag": result["etag"],
+                "size": os.path.getsize(model_file)}
+    storage.upload_bytes("models/latest.json", json.dumps(manifest).encode(), content_type="application/json")
+    logging.info(f"Seeded {container} ({storage.STORAGE_BACKEND}) with {model_file}.")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(env: dict, port: int, workers: int, timeout: float):
+    """Start flowerpredict with uvicorn and wait until /ready answers."""
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers)],
+        cwd=PREDICT_DIR,
+        env=env,
+    )
+    url = f"http://127.0.0.1:{port}"
+    start = time.monotonic()
+    while time.monotonic() < start + timeout:
+        if process.poll() is not None:
+            raise RuntimeError("flowerpredict exited during startup")
+        try:
+            if requests.get(f"{url}/ready").ok:
+                logging.info(f"flowerpredict ready after {time.monotonic() - start:.1f} s")
+                return process, url, time.monotonic() - start
+        except requests.exceptions.ConnectionError:
+            pass
+        time.sleep(0.5)
+    process.terminate()
+    raise RuntimeError(f"flowerpredict did not become ready in {timeout} s")
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+def format_ms(value) -> str:
+    # Latencies are None when every request of a scenario failed
+    return "n/a" if value is None else f"{value:.1f} ms"
+
+
+def run_scenario(url: str, images: list, concurrency: int, n_requests: int, warmup: int) -> dict:
+    """Send n_requests /predict requests with the given concurrency."""
+    local = threading.local()
+
+    def send(i):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        image = images[i % len(images)]
+        start = time.perf_counter()
+        try:
+            response = local.session.post(f"{url}/predict", files={"image_file": ("bench.jpg", image, "image/jpeg")})
+            ok = response.ok
+        except requests.exceptions.RequestException:
+            ok = False
+        return time.perf_counter() - start, ok
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(send, range(warmup)))
+
+        start = time.perf_counter()
+        results = list(pool.map(send, range(n_requests)))
+        elapsed = time.perf_counter() - start
+
+    latencies = [latency * 1000.0 for latency, ok in results if ok]
+    return {
+        "concurrency": concurrency,
+        "requests": n_requests,
+        "errors": sum(1 for _, ok in results if not ok),
+        "elapsed_s": elapsed,
+        "throughput_rps": len(latencies) / elapsed if elapsed else 0.0,
+        "latency_ms": {
+            "mean": float(np.mean(latencies)) if latencies else None,
+            "p50": percentile(latencies, 50),
+            "p90": percentile(latencies, 90),
+            "p99": percentile(latencies, 99),
+            "max": max(latencies) if latencies else None,
+        },
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Return the scenarios where throughput dropped or p50/p99 latency grew by
+    more than tolerance compared with the baseline report.
+    """
+    regressions = []
+    previous = {(s["image_size"], s["concurrency"]): s for s in baseline["scenarios"]}
+    for scenario in report["scenarios"]:
+        old = previous.get((scenario["image_size"], scenario["concurrency"]))
+        if old is None:
+            continue
+        name = f"{scenario['image_size']} @ {scenario['concurrency']}"
+        if scenario["throughput_rps"] < old["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{name}: throughput {old['throughput_rps']:.2f} -> {scenario['throughput_rps']:.2f} req/s")
+        for q in ("p50", "p99"):
+            new_ms, old_ms = scenario["latency_ms"][q], old["latency_ms"][q]
+            if new_ms is not None and old_ms is not None and new_ms > old_ms * (1 + tolerance):
+                regressions.append(f"{name}: {q} {old_ms:.1f} -> {new_ms:.1f} ms")
+    return regressions
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=HERE, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test for flowerpredict /predict")
+    parser.add_argument("--model", default=os.path.join(HERE, "..", "azurite_populate", "flowers_1.keras"),
+                        help="Model file to seed the storage with")
+    parser.add_argument("--no-seed", action="store_true", help="Use the model already in storage")
+    parser.add_argument("--connection-string", default=os.environ.get("STORAGE_CONNECTION_STRING", AZURITE_CONNECTION_STRING))
+    parser.add_argument("--container", default="benchcontainer")
+    parser.add_argument("--storage-backend", choices=["azure", "local"], default="azure",
+                        help="azure uses --connection-string, local a directory without a storage service")
+    parser.add_argument("--local-dir", default=os.path.join(HERE, "bench_storage"),
+                        help="Storage directory of the local backend")
+    parser.add_argument("--url", help="Benchmark an already running service instead of starting one")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--image-sizes", nargs="+", default=["224x224", "1024x768", "4000x3000"])
+    parser.add_argument("--requests", type=int, default=200, help="Measured requests per scenario")
+    parser.add_argument("--warmup", type=int, default=10, help="Unmeasured requests per scenario")
+    parser.add_argument("--unique-images", type=int, default=20,
+                        help="Distinct images per size (the prediction cache is disabled unless --cache)")
+    parser.add_argument("--cache", action="store_true", help="Leave the prediction cache on")
+    parser.add_argument("--server-env", nargs="*", default=[], metavar="KEY=VALUE",
+                        help="Extra environment for flowerpredict, e.g. INFERENCE_ENGINE=tflite")
+    parser.add_argument("--startup-timeout", type=float, default=300)
+    parser.add_argument("--seed", type=int, default=123)
+    parser.add_argument("--output", default="benchmark_report.json")
+    parser.add_argument("--baseline", help="Earlier report to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative regression")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    env = dict(os.environ)
+    env.update({
+        "USE_AZURE_CREDENTIAL": "false",
+        "STORAGE_CONNECTION_STRING": args.connection_string,
+        "STORAGE_BACKEND": args.storage_backend,
+        "STORAGE_LOCAL_DIR": os.path.abspath(args.local_dir),
+        "STORAGE_CONTAINER": args.container,
+        "STORAGE_QUEUE": "benchqueue",
+        "PREDICTION_CACHE_ENABLED": "true" if args.cache else "false",
+    })
+    env.pop("PROMETHEUS_MULTIPROC_DIR", None)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [COMMON_DIR, env.get("PYTHONPATH")]))
+    env.update(dict(item.split("=", 1) for item in args.server_env))
+
+    process = None
+    startup_s = None
+    if args.url:
+        url = args.url.rstrip("/")
+    else:
+        if not args.no_seed:
+            seed_storage(env, args.model)
+        process, url, startup_s = start_server(env, free_port(), args.workers, args.startup_timeout)
+
+    try:
+        scenarios = []
+        for size in args.image_sizes:
+            width, height = parse_size(size)
+            images = [make_jpeg(width, height, seed=args.seed + i) for i in range(args.unique_images)]
+            for concurrency in args.concurrency:
+                logging.info(f"Running {args.requests} requests of {size} images at concurrency {concurrency}")
+                result = run_scenario(url, images, concurrency, args.requests, args.warmup)
+                result["image_size"] = size
+                result["image_bytes_mean"] = float(np.mean([len(image) for image in images]))
+                scenarios.append(result)
+                logging.info(
+                    f"{size} @ {concurrency}: {result['throughput_rps']:.2f} req/s, "
+                    f"p50 {format_ms(result['latency_ms']['p50'])}, p99 {format_ms(result['latency_ms']['p99'])}, "
+                    f"{result['errors']} errors"
+                )
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    report = {
+        "created_at": datetime.now().isoformat(),
+        "git_commit": git_commit(),
+        "host": {"platform": platform.platform(), "python": platform.python_version(), "cpus": os.cpu_count()},
+        "config": {
+            "workers": args.workers,
+            "requests": args.requests,
+            "warmup": args.warmup,
+            "unique_images": args.unique_images,
+            "cache": args.cache,
+            "server_env": args.server_env,
+            "storage_backend": args.storage_backend,
+        },
+        "startup_s": startup_s,
+        "scenarios": scenarios,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    logging.info(f"Wrote {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            logging.error(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""
+The delta artifact format shared by the modeller, which writes the deltas,
+and flowerpredict, which applies them on top of a base model.
+"""
+
+import numpy as np
+
+
+def save_delta(model, base_weights: list, file_path: str) -> int:
+    """
+    Write the weights that differ from base_weights to a compressed .npz file.
+    The weights are stored by their position in model.get_weights(), which
+    is the same for every model with this architecture. Returns the number
+    of changed weight arrays.
+    """
+    weights = model.get_weights()
+    if len(weights) != len(base_weights):
+        raise ValueError("The model does not have the same architecture as its base")
+    changed = {
+        f"w{i}": weight for i, (weight, base) in enumerate(zip(weights, base_weights))
+        if weight.shape != base.shape or not np.array_equal(weight, base)
+    }
+    np.savez_compressed(file_path, n_weights=len(weights), **changed)
+    return len(changed)
+
+
+def apply_delta(model, delta_file):
+    """Overwrite the weights of a base model with the ones stored in a delta file."""
+    with np.load(delta_file) as delta:
+        weights = model.get_weights()
+        if int(delta["n_weights"]) != len(weights):
+            raise ValueError("The delta does not match the architecture of the base model")
+        for key in delta.files:
+            if key.startswith("w"):
+                weights[int(key[1:])] = delta[key]
+    model.set_weights(weights)
+    return model
@@ -0,0 +1,603 @@
+"""
+Local-directory storage backend, selected with STORAGE_BACKEND=local.
+
+Implements the part of the azure.storage.blob and azure.storage.queue client
+API that the services use, on top of a directory that all processes on the
+node share (STORAGE_LOCAL_DIR):
+
+    blobs/<container>/<blob name>       blob contents
+    metadata/<container>/<blob name>    metadata, content type and lease
+    queues/<queue>/<message id>~<pop receipt>
+
+Every write goes to a temporary file that is renamed into place, so readers
+never see a half-written blob or message. Blobs are read through mmap, and
+blob_path() gives the file itself to readers that can open it directly.
+
+A message is claimed by renaming it to a new pop receipt, which holds the
+time the message becomes visible again. Only one process can win the
+rename, so the queue works like an Azure queue between processes.
+
+Errors are raised as the same azure.core exceptions the Azure clients raise.
+"""
+
+import os
+import json
+import mmap
+import uuid
+import time
+import fcntl
+import shutil
+import asyncio
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Optional
+
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    HttpResponseError, ResourceExistsError, ResourceModifiedError, ResourceNotFoundError, ResourceNotModifiedError,
+)
+
+# Chunk size of downloader.chunks()
+CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def _now_us() -> int:
+    return time.time_ns() // 1000
+
+
+def _from_us(us: int) -> datetime:
+    return datetime.fromtimestamp(us / 1e6, timezone.utc)
+
+
+def _check_name(name: str) -> str:
+    parts = name.split("/")
+    if not name or name.startswith("/") or any(part in ("", ".", "..") for part in parts):
+        raise ValueError(f"Invalid storage name: {name!r}")
+    return name
+
+
+def _write_temp(path: str, data) -> str:
+    """
+    Write bytes, str or a binary file object to a hidden temporary file next
+    to path and return its name. Rename it to path to publish it.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        with open(temp_path, "wb") as f:
+            if isinstance(data, str):
+                data = data.encode()
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                f.write(data)
+            else:
+                shutil.copyfileobj(data, f, CHUNK_SIZE)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+    return temp_path
+
+
+def _write_atomic(path: str, data):
+    os.replace(_write_temp(path, data), path)
+
+
+def _error(error_type, status_code: int, message: str) -> HttpResponseError:
+    # The Azure clients set status_code on their errors, callers may check it
+    error = error_type(message)
+    error.status_code = status_code
+    return error
+
+
+def _conflict(message: str) -> HttpResponseError:
+    return _error(ResourceExistsError, 409, message)
+
+
+class ContentSettings:
+    def __init__(self, content_type: Optional[str] = None):
+        self.content_type = content_type
+        # Not computed locally, load_valdata() skips the check when it is missing
+        self.content_md5 = None
+
+
+class BlobProperties:
+    def __init__(self, name: str, container: str, stat: os.stat_result, metadata: dict, content_type: Optional[str]):
+        self.name = name
+        self.container = container
+        self.size = stat.st_size
+        # Every write renames a new file into place, so the inode and mtime identify the contents
+        self.etag = f'"0x{stat.st_ino:x}{stat.st_mtime_ns:x}"'
+        self.last_modified = datetime.fromtimestamp(stat.st_mtime, timezone.utc)
+        self.metadata = metadata
+        self.content_settings = ContentSettings(content_type)
+
+
+class Named:
+    def __init__(self, name: str):
+        self.name = name
+
+
+class BlobDownloader:
+    """Like StorageStreamDownloader, reads the file through a memory map."""
+
+    def __init__(self, f, properties: BlobProperties):
+        self.name = properties.name
+        self.properties = properties
+        self.size = properties.size
+        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+
+    def _view(self) -> memoryview:
+        return memoryview(self._map) if self._map is not None else memoryview(b"")
+
+    def readall(self) -> bytes:
+        return self._view().tobytes()
+
+    def readinto(self, stream) -> int:
+        stream.write(self._view())
+        return self.size
+
+    def chunks(self):
+        view = self._view()
+        for start in range(0, self.size, CHUNK_SIZE):
+            yield view[start:start + CHUNK_SIZE]
+
+
+class BlobLease:
+    def __init__(self, blob_client, lease_id: str, duration: int):
+        self.blob_client = blob_client
+        self.id = lease_id
+        self.duration = duration
+
+    def renew(self, **kwargs):
+        self.blob_client._lease(self.id, self.duration, renew=True)
+
+    def release(self, **kwargs):
+        self.blob_client._lease(self.id, 0, release=True)
+
+
+class LocalBlobClient:
+    def __init__(self, root: str, container_name: str, blob_name: str):
+        self.root = root
+        self.container_name = container_name
+        self.blob_name = _check_name(blob_name)
+        self.path = os.path.join(root, "blobs", container_name, blob_name)
+        self._meta_path = os.path.join(root, "metadata", container_name, blob_name)
+        self._lock_path = os.path.join(root, "metadata", container_name, ".lock")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def close(self):
+        pass
+
+    @contextmanager
+    def _locked(self):
+        """Serialize metadata, lease and create-only writes in the container between processes."""
+        os.makedirs(os.path.dirname(self._lock_path), exist_ok=True)
+        with open(self._lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _read_meta(self) -> dict:
+        try:
+            with open(self._meta_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def _write_meta(self, **changes):
+        meta = {**self._read_meta(), **changes}
+        _write_atomic(self._meta_path, json.dumps(meta))
+
+    def exists(self, **kwargs) -> bool:
+        return os.path.isfile(self.path)
+
+    def _properties(self, stat: os.stat_result) -> BlobProperties:
+        meta = self._read_meta()
+        return BlobProperties(self.blob_name, self.container_name, stat, meta.get("metadata", {}),
+                              meta.get("content_type"))
+
+    def get_blob_properties(self, **kwargs) -> BlobProperties:
+        try:
+            return self._properties(os.stat(self.path))
+        except FileNotFoundError:
+            raise ResourceNotFoundError(f"The blob {self.blob_name} does not exist.")
+
+    def download_blob(self, etag: Optional[str] = None, match_condition: Optional[MatchConditions] = None,
+                      **kwargs) -> BlobDownloader:
+        try:
+            f = open(self.path, "rb")
+        except FileNotFoundError:
+            raise ResourceNotFoundError(f"The blob {self.blob_name} does not exist.")
+        with f:
+            # Properties of the opened file, it may be replaced by a new version at any time
+            properties = self._properties(os.fstat(f.fileno()))
+            if etag is not None and match_condition == MatchConditions.IfModified and properties.etag == etag:
+                raise _error(ResourceNotModifiedError, 304, f"The blob {self.blob_name} has not been modified.")
+            if etag is not None and match_condition == MatchConditions.IfNotModified and properties.etag != etag:
+                raise _error(ResourceModifiedError, 412, f"The blob {self.blob_name} has been modified.")
+            return BlobDownloader(f, properties)
+
+    def upload_blob(self, data, overwrite: bool = False, metadata: Optional[dict] = None,
+                    content_settings=None, etag: Optional[str] = None,
+                    match_condition: Optional[MatchConditions] = None, **kwargs) -> dict:
+        if not os.path.isdir(os.path.join(self.root, "blobs", self.container_name)):
+            raise ResourceNotFoundError(f"The container {self.container_name} does not exist.")
+        # The contents are written outside the lock, only the renames are serialized
+        temp_path = _write_temp(self.path, data)
+        try:
+            with self._locked():
+                if not overwrite and self.exists():
+                    raise ResourceExistsError(f"The blob {self.blob_name} already exists.")
+                if etag is not None and match_condition == MatchConditions.IfNotModified and (
+                        not self.exists() or self.get_blob_properties().etag != etag):
+                    raise _error(ResourceModifiedError, 412, f"The blob {self.blob_name} has been modified.")
+                # Renamed before the contents, so list_blobs() never sees a new blob without its metadata
+                meta = {"metadata": dict(metadata or {}), "lease": self._read_meta().get("lease")}
+                if content_settings is not None and content_settings.content_type:
+                    meta["content_type"] = content_settings.content_type
+                _write_atomic(self._meta_path, json.dumps(meta))
+                os.replace(temp_path, self.path)
+                properties = self._properties(os.stat(self.path))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        return {"etag": properties.etag, "last_modified": properties.last_modified}
+
+    def set_blob_metadata(self, metadata: Optional[dict] = None, **kwargs) -> dict:
+        with self._locked():
+            properties = self.get_blob_properties()
+            self._write_meta(metadata=dict(metadata or {}))
+        return {"etag": properties.etag, "last_modified": properties.last_modified}
+
+    def delete_blob(self, **kwargs):
+        with self._locked():
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                raise ResourceNotFoundError(f"The blob {self.blob_name} does not exist.")
+            if os.path.exists(self._meta_path):
+                os.remove(self._meta_path)
+
+    def acquire_lease(self, lease_duration: int = -1, lease_id: Optional[str] = None, **kwargs) -> BlobLease:
+        if not self.exists():
+            raise ResourceNotFoundError(f"The blob {self.blob_name} does not exist.")
+        lease_id = lease_id or str(uuid.uuid4())
+        self._lease(lease_id, lease_duration)
+        return BlobLease(self, lease_id, lease_duration)
+
+    def _lease(self, lease_id: str, duration: int, renew: bool = False, release: bool = False):
+        """Take, renew or release the lease."""
+        with self._locked():
+            lease = self._read_meta().get("lease")
+            held = lease is not None and (lease["expires"] is None or lease["expires"] > time.time())
+            if held and lease["id"] != lease_id:
+                raise _conflict(f"There is already a lease on {self.blob_name}.")
+            if (renew or release) and (lease is None or lease["id"] != lease_id):
+                raise _conflict(f"The lease on {self.blob_name} is not held with this lease id.")
+            if release:
+                self._write_meta(lease=None)
+            else:
+                self._write_meta(lease={"id": lease_id, "expires": time.time() + duration if duration > 0 else None})
+
+
+class LocalContainerClient:
+    def __init__(self, root: str, container_name: str):
+        self.root = root
+        self.container_name = _check_name(container_name)
+        self.path = os.path.join(root, "blobs", container_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def close(self):
+        pass
+
+    def exists(self, **kwargs) -> bool:
+        return os.path.isdir(self.path)
+
+    def get_blob_client(self, blob) -> LocalBlobClient:
+        return LocalBlobClient(self.root, self.container_name, getattr(blob, "name", blob))
+
+    def list_blobs(self, name_starts_with: Optional[str] = None, include=None, **kwargs):
+        """Blob properties in name order, skipping files that are still being written."""
+        prefix = name_starts_with or ""
+        start = os.path.join(self.path, os.path.dirname(prefix))
+        names = []
+        for directory, _, files in os.walk(start):
+            for file_name in files:
+                if file_name.startswith("."):
+                    continue
+                name = os.path.relpath(os.path.join(directory, file_name), self.path).replace(os.sep, "/")
+                if name.startswith(prefix):
+                    names.append(name)
+        for name in sorted(names):
+            blob_client = self.get_blob_client(name)
+            try:
+                properties = blob_client.get_blob_properties()
+            except ResourceNotFoundError:
+                # Deleted while listing
+                continue
+            if not include or "metadata" not in include:
+                properties.metadata = {}
+            yield properties
+
+    def upload_blob(self, name: str, data, **kwargs) -> LocalBlobClient:
+        blob_client = self.get_blob_client(name)
+        blob_client.upload_blob(data, **kwargs)
+        return blob_client
+
+    def delete_blob(self, blob, **kwargs):
+        self.get_blob_client(blob).delete_blob()
+
+    def delete_blobs(self, *blobs, **kwargs):
+        for blob in blobs:
+            try:
+                self.delete_blob(blob)
+            except ResourceNotFoundError:
+                pass
+
+
+class LocalBlobServiceClient:
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(os.path.join(root, "blobs"), exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def close(self):
+        pass
+
+    def get_container_client(self, container) -> LocalContainerClient:
+        return LocalContainerClient(self.root, getattr(container, "name", container))
+
+    def get_blob_client(self, container, blob) -> LocalBlobClient:
+        return self.get_container_client(container).get_blob_client(blob)
+
+    def create_container(self, name: str, **kwargs) -> LocalContainerClient:
+        container_client = self.get_container_client(name)
+        try:
+            os.mkdir(container_client.path)
+        except FileExistsError:
+            raise ResourceExistsError(f"The container {name} already exists.")
+        return container_client
+
+    def list_containers(self, name_starts_with: Optional[str] = None, **kwargs):
+        for name in sorted(os.listdir(os.path.join(self.root, "blobs"))):
+            if name.startswith(name_starts_with or ""):
+                yield Named(name)
+
+
+class QueueMessage:
+    def __init__(self, message_id: str, pop_receipt: str, content: Optional[str] = None):
+        self.id = message_id
+        self.pop_receipt = pop_receipt
+        self.content = content
+        self.inserted_on = _from_us(int(message_id.split("-")[0]))
+        self.next_visible_on = _from_us(int(pop_receipt.split("-")[0]))
+
+
+class LocalQueueClient:
+    """
+    Queue spool in queues/<queue>. The file name of a message is
+    "<id>~<pop receipt>", where the id starts with the insert time and the
+    pop receipt with the time the message is visible again, in microseconds.
+    """
+
+    def __init__(self, root: str, queue_name: str):
+        self.root = root
+        self.queue_name = _check_name(queue_name)
+        self.path = os.path.join(root, "queues", queue_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def close(self):
+        pass
+
+    def _check_exists(self):
+        if not os.path.isdir(self.path):
+            raise ResourceNotFoundError(f"The queue {self.queue_name} does not exist.")
+
+    def _messages(self) -> list:
+        """(id, pop receipt) of every message, oldest first."""
+        self._check_exists()
+        return sorted(
+            tuple(file_name.split("~", 1)) for file_name in os.listdir(self.path)
+            if not file_name.startswith(".") and "~" in file_name
+        )
+
+    def _file(self, message_id: str, pop_receipt: str) -> str:
+        return os.path.join(self.path, f"{message_id}~{pop_receipt}")
+
+    def _read(self, message_id: str, pop_receipt: str) -> str:
+        with open(self._file(message_id, pop_receipt)) as f:
+            return f.read()
+
+    def send_message(self, content: str, **kwargs) -> QueueMessage:
+        self._check_exists()
+        now = _now_us()
+        message = QueueMessage(f"{now:016d}-{uuid.uuid4().hex[:12]}", f"{now:016d}-0")
+        _write_atomic(self._file(message.id, message.pop_receipt), content)
+        message.content = content
+        return message
+
+    def get_queue_properties(self, **kwargs):
+        properties = Named(self.queue_name)
+        properties.approximate_message_count = len(self._messages())
+        return properties
+
+    def peek_messages(self, max_messages: Optional[int] = None, **kwargs) -> list:
+        now = _now_us()
+        peeked = []
+        for message_id, pop_receipt in self._messages():
+            if len(peeked) >= (max_messages or 1):
+                break
+            if int(pop_receipt.split("-")[0]) > now:
+                continue
+            try:
+                peeked.append(QueueMessage(message_id, pop_receipt, self._read(message_id, pop_receipt)))
+            except FileNotFoundError:
+                continue
+        return peeked
+
+    def receive_messages(self, visibility_timeout: Optional[int] = None, max_messages: Optional[int] = None,
+                         **kwargs):
+        """Claim visible messages one at a time, hiding each for visibility_timeout seconds."""
+        received = 0
+        for message_id, pop_receipt in self._messages():
+            if max_messages is not None and received >= max_messages:
+                return
+            now = _now_us()
+            if int(pop_receipt.split("-")[0]) > now:
+                continue
+            new_receipt = f"{now + int((30 if visibility_timeout is None else visibility_timeout) * 1e6):016d}-{uuid.uuid4().hex[:8]}"
+            try:
+                os.rename(self._file(message_id, pop_receipt), self._file(message_id, new_receipt))
+            except FileNotFoundError:
+                # Claimed or deleted by another reader in the meantime
+                continue
+            received += 1
+            yield QueueMessage(message_id, new_receipt, self._read(message_id, new_receipt))
+
+    def update_message(self, message, pop_receipt: Optional[str] = None, visibility_timeout: Optional[int] = None,
+                       **kwargs) -> QueueMessage:
+        message_id = getattr(message, "id", message)
+        pop_receipt = pop_receipt or message.pop_receipt
+        new_receipt = f"{_now_us() + int((visibility_timeout or 0) * 1e6):016d}-{uuid.uuid4().hex[:8]}"
+        try:
+            os.rename(self._file(message_id, pop_receipt), self._file(message_id, new_receipt))
+        except FileNotFoundError:
+            raise ResourceNotFoundError(f"The message {message_id} does not exist or the pop receipt is stale.")
+        return QueueMessage(message_id, new_receipt)
+
+    def delete_message(self, message, pop_receipt: Optional[str] = None, **kwargs):
+        message_id = getattr(message, "id", message)
+        pop_receipt = pop_receipt or message.pop_receipt
+        try:
+            os.remove(self._file(message_id, pop_receipt))
+        except FileNotFoundError:
+            raise ResourceNotFoundError(f"The message {message_id} does not exist or the pop receipt is stale.")
+
+
+class LocalQueueServiceClient:
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(os.path.join(root, "queues"), exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def close(self):
+        pass
+
+    def get_queue_client(self, queue) -> LocalQueueClient:
+        return LocalQueueClient(self.root, getattr(queue, "name", queue))
+
+    def create_queue(self, name: str, **kwargs) -> LocalQueueClient:
+        queue_client = self.get_queue_client(name)
+        try:
+            os.mkdir(queue_client.path)
+        except FileExistsError:
+            raise ResourceExistsError(f"The queue {name} already exists.")
+        return queue_client
+
+    def list_queues(self, name_starts_with: Optional[str] = None, **kwargs):
+        for name in sorted(os.listdir(os.path.join(self.root, "queues"))):
+            if name.startswith(name_starts_with or ""):
+                yield Named(name)
+
+
+# Async versions for the modeller pipeline. The local calls are short file
+# operations, so they run in a worker thread only where they may block on I/O.
+
+class AioBlobDownloader:
+    def __init__(self, downloader: BlobDownloader):
+        self.properties = downloader.properties
+        self.size = downloader.size
+        self._downloader = downloader
+
+    async def readall(self) -> bytes:
+        return await asyncio.to_thread(self._downloader.readall)
+
+
+class AioLocalBlobClient:
+    def __init__(self, blob_client: LocalBlobClient):
+        self.blob_name = blob_client.blob_name
+        self._blob_client = blob_client
+
+    async def download_blob(self, **kwargs) -> AioBlobDownloader:
+        return AioBlobDownloader(await asyncio.to_thread(self._blob_client.download_blob, **kwargs))
+
+
+class AioLocalContainerClient:
+    def __init__(self, container_client: LocalContainerClient):
+        self._container_client = container_client
+
+    def get_blob_client(self, blob) -> AioLocalBlobClient:
+        return AioLocalBlobClient(self._container_client.get_blob_client(blob))
+
+    async def delete_blob(self, blob, **kwargs):
+        self._container_client.delete_blob(blob)
+
+    async def delete_blobs(self, *blobs, **kwargs):
+        await asyncio.to_thread(self._container_client.delete_blobs, *blobs)
+
+
+class AioLocalQueueClient:
+    def __init__(self, queue_client: LocalQueueClient):
+        self._queue_client = queue_client
+
+    async def receive_messages(self, **kwargs):
+        for message in self._queue_client.receive_messages(**kwargs):
+            yield message
+
+    async def update_message(self, message, **kwargs) -> QueueMessage:
+        return self._queue_client.update_message(message, **kwargs)
+
+    async def delete_message(self, message, **kwargs):
+        self._queue_client.delete_message(message, **kwargs)
+
+
+class AioLocalBlobServiceClient:
+    def __init__(self, root: str):
+        self._client = LocalBlobServiceClient(root)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    def get_container_client(self, container) -> AioLocalContainerClient:
+        return AioLocalContainerClient(self._client.get_container_client(container))
+
+
+class AioLocalQueueServiceClient:
+    def __init__(self, root: str):
+        self._client = LocalQueueServiceClient(root)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    def get_queue_client(self, queue) -> AioLocalQueueClient:
+        return AioLocalQueueClient(self._client.get_queue_client(queue))
@@ -0,0 +1,248 @@
+"""
+Shared storage access for all services.
+
+The Dockerfiles copy this file and localstore.py next to each service's own
+modules. Locally, add src/common to PYTHONPATH.
+
+STORAGE_BACKEND selects where blobs and queue messages are kept: "azure"
+for Azure Storage or Azurite, "local" for a directory on this node (see
+localstore.py). Both return clients with the same interface, the part of
+the azure.storage client API the services use.
+
+The clients are process-wide singletons, so connections are pooled and
+kept alive between calls and, in the cloud, DefaultAzureCredential fetches
+its token once and refreshes it in the background. Do not use the clients
+as context managers, that would close the shared connection pool.
+"""
+
+import os
+import threading
+import contextvars
+
+from contextlib import asynccontextmanager, AsyncExitStack
+from functools import lru_cache
+from typing import Optional
+
+from requests import Session
+from requests.adapters import HTTPAdapter
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import BlobServiceClient, ContentSettings, ExponentialRetry as BlobRetry
+from azure.storage.queue import QueueServiceClient, ExponentialRetry as QueueRetry
+
+from localstore import (
+    LocalBlobServiceClient, LocalQueueServiceClient, AioLocalBlobServiceClient, AioLocalQueueServiceClient,
+)
+
+# "azure" or "local", the local backend keeps everything under STORAGE_LOCAL_DIR
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "azure").lower()
+STORAGE_LOCAL_DIR = os.environ.get("STORAGE_LOCAL_DIR", "./storage")
+if STORAGE_BACKEND not in ("azure", "local"):
+    raise ValueError(f"Unknown STORAGE_BACKEND {STORAGE_BACKEND}, use azure or local")
+
+# Are we running in the cloud? Locally we use Azurite through STORAGE_CONNECTION_STRING.
+CLOUD = os.environ.get("USE_AZURE_CREDENTIAL", "false").lower() == "true"
+
+# HTTP connections kept open per client, should cover the number of concurrent transfers
+STORAGE_POOL_SIZE = int(os.environ.get("STORAGE_POOL_SIZE", "32"))
+STORAGE_CONNECTION_TIMEOUT = float(os.environ.get("STORAGE_CONNECTION_TIMEOUT", "10"))
+STORAGE_READ_TIMEOUT = float(os.environ.get("STORAGE_READ_TIMEOUT", "120"))
+# Failed requests are retried with exponential backoff: backoff, backoff + 2, backoff + 4, ... seconds
+STORAGE_RETRY_TOTAL = int(os.environ.get("STORAGE_RETRY_TOTAL", "5"))
+STORAGE_RETRY_BACKOFF = float(os.environ.get("STORAGE_RETRY_BACKOFF", "1"))
+
+# Large blobs are transferred in blocks of this size, TRANSFER_CONCURRENCY blocks at a time
+TRANSFER_BLOCK_SIZE = int(os.environ.get("STORAGE_BLOCK_SIZE", str(4 * 1024 * 1024)))
+TRANSFER_CONCURRENCY = int(os.environ.get("STORAGE_TRANSFER_CONCURRENCY", "8"))
+TRANSFER_OPTIONS = {
+    "max_block_size": TRANSFER_BLOCK_SIZE,
+    "max_single_put_size": TRANSFER_BLOCK_SIZE,
+    "max_chunk_get_size": TRANSFER_BLOCK_SIZE,
+    "max_single_get_size": TRANSFER_BLOCK_SIZE,
+}
+
+# Bytes moved to and from the storage by this process
+TRANSFERRED_BYTES = {"downloaded": 0, "uploaded": 0}
+# Extra counters for the current thread or asyncio task, e.g. one per profiled stage
+TRANSFER_COUNTERS = contextvars.ContextVar("TRANSFER_COUNTERS", default=())
+_transfer_lock = threading.Lock()
+
+
+def count_transfer(direction: str, n_bytes: int):
+    with _transfer_lock:
+        TRANSFERRED_BYTES[direction] += n_bytes
+        for counter in TRANSFER_COUNTERS.get():
+            counter[direction] += n_bytes
+
+
+def with_transfer_counters(fn):
+    """
+    Wrap fn so that it counts its transfers towards the caller's counters
+    when it runs in a worker thread. ThreadPoolExecutor does not copy the
+    caller's context, asyncio.to_thread does.
+    """
+    counters = TRANSFER_COUNTERS.get()
+
+    def run(*args, **kwargs):
+        token = TRANSFER_COUNTERS.set(counters)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            TRANSFER_COUNTERS.reset(token)
+    return run
+
+
+@lru_cache(maxsize=None)
+def get_credential():
+    from azure.identity import DefaultAzureCredential # type: ignore
+    return DefaultAzureCredential()
+
+
+def _transport() -> RequestsTransport:
+    session = Session()
+    adapter = HTTPAdapter(pool_connections=STORAGE_POOL_SIZE, pool_maxsize=STORAGE_POOL_SIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # The timeouts only take effect on the transport, the clients ignore them when given a transport
+    return RequestsTransport(session=session, session_owner=False, connection_timeout=STORAGE_CONNECTION_TIMEOUT,
+                             read_timeout=STORAGE_READ_TIMEOUT)
+
+
+def _client_options(retry_policy, transport=None) -> dict:
+    return {"transport": transport or _transport(), "retry_policy": retry_policy}
+
+
+@lru_cache(maxsize=None)
+def get_blob_service_client() -> BlobServiceClient:
+    if STORAGE_BACKEND == "local":
+        return LocalBlobServiceClient(STORAGE_LOCAL_DIR)
+    options = _client_options(BlobRetry(initial_backoff=STORAGE_RETRY_BACKOFF, increment_base=2,
+                                        retry_total=STORAGE_RETRY_TOTAL))
+    options.update(TRANSFER_OPTIONS)
+    if CLOUD:
+        return BlobServiceClient(account_url=os.environ["STORAGE_BLOB_URL"], credential=get_credential(), **options)
+    return BlobServiceClient.from_connection_string(os.environ["STORAGE_CONNECTION_STRING"], **options)
+
+
+@lru_cache(maxsize=None)
+def get_queue_service_client() -> QueueServiceClient:
+    if STORAGE_BACKEND == "local":
+        return LocalQueueServiceClient(STORAGE_LOCAL_DIR)
+    options = _client_options(QueueRetry(initial_backoff=STORAGE_RETRY_BACKOFF, increment_base=2,
+                                         retry_total=STORAGE_RETRY_TOTAL))
+    if CLOUD:
+        return QueueServiceClient(account_url=os.environ["STORAGE_QUEUE_URL"], credential=get_credential(), **options)
+    return QueueServiceClient.from_connection_string(os.environ["STORAGE_CONNECTION_STRING"], **options)
+
+
+def get_container_client(container: Optional[str] = None):
+    return get_blob_service_client().get_container_client(container or os.environ["STORAGE_CONTAINER"])
+
+
+def get_queue_client(queue: Optional[str] = None):
+    return get_queue_service_client().get_queue_client(queue or os.environ["STORAGE_QUEUE"])
+
+
+def blob_path(blob_name: str, container: Optional[str] = None) -> Optional[str]:
+    """
+    Path of the blob's own file with the local backend, so it can be read in
+    place instead of copied. None with Azure or if the blob does not exist.
+    """
+    if STORAGE_BACKEND != "local":
+        return None
+    blob_client = get_container_client(container).get_blob_client(blob_name)
+    return blob_client.path if blob_client.exists() else None
+
+
+def download_bytes(blob_name: str, container: Optional[str] = None) -> bytes:
+    data = get_container_client(container).get_blob_client(blob_name).download_blob(
+        max_concurrency=TRANSFER_CONCURRENCY
+    ).readall()
+    count_transfer("downloaded", len(data))
+    return data
+
+
+def download_to_file(blob_name: str, file, container: Optional[str] = None) -> int:
+    """Download a blob into an open binary file in parallel blocks, returns the number of bytes."""
+    n_bytes = get_container_client(container).get_blob_client(blob_name).download_blob(
+        max_concurrency=TRANSFER_CONCURRENCY
+    ).readinto(file)
+    count_transfer("downloaded", n_bytes)
+    return n_bytes
+
+
+def upload_file(blob_name: str, file_path: str, metadata: Optional[dict] = None,
+                container: Optional[str] = None) -> dict:
+    """Upload a local file in parallel blocks and return the upload result (etag etc.)."""
+    with open(file_path, "rb") as data:
+        result = get_container_client(container).get_blob_client(blob_name).upload_blob(
+            data, overwrite=True, metadata=metadata, max_concurrency=TRANSFER_CONCURRENCY
+        )
+    count_transfer("uploaded", os.path.getsize(file_path))
+    return result
+
+
+def upload_bytes(blob_name: str, data, content_type: Optional[str] = None,
+                 container: Optional[str] = None, overwrite: bool = True, **kwargs) -> dict:
+    """
+    Upload bytes. With overwrite=False an existing blob raises ResourceExistsError.
+    Other keyword arguments, e.g. etag and match_condition, go to upload_blob().
+    """
+    content_settings = ContentSettings(content_type=content_type) if content_type else None
+    result = get_container_client(container).get_blob_client(blob_name).upload_blob(
+        data, overwrite=overwrite, content_settings=content_settings, **kwargs
+    )
+    count_transfer("uploaded", len(data))
+    return result
+
+
+def send_message(content: str, queue: Optional[str] = None):
+    return get_queue_client(queue).send_message(content)
+
+
+@asynccontextmanager
+async def aio_clients():
+    """
+    New async blob and queue service clients, configured like the sync ones
+    and with their own connection pools. They are bound to the running event
+    loop, so they are opened for one async with block and closed, together
+    with their credential and connection pools, when it exits.
+    """
+    if STORAGE_BACKEND == "local":
+        async with AioLocalBlobServiceClient(STORAGE_LOCAL_DIR) as blob_service_client, \
+                AioLocalQueueServiceClient(STORAGE_LOCAL_DIR) as queue_service_client:
+            yield blob_service_client, queue_service_client
+        return
+
+    from aiohttp import ClientSession, TCPConnector
+    from azure.core.pipeline.transport import AioHttpTransport
+    from azure.storage.blob.aio import BlobServiceClient as AioBlobServiceClient
+    from azure.storage.queue.aio import QueueServiceClient as AioQueueServiceClient
+
+    async with AsyncExitStack() as stack:
+        # Closed in reverse order: clients, credential, connection pools
+        def transport():
+            session = ClientSession(connector=TCPConnector(limit=STORAGE_POOL_SIZE))
+            stack.push_async_callback(session.close)
+            return AioHttpTransport(session=session, session_owner=False,
+                                    connection_timeout=STORAGE_CONNECTION_TIMEOUT, read_timeout=STORAGE_READ_TIMEOUT)
+
+        blob_options = _client_options(BlobRetry(initial_backoff=STORAGE_RETRY_BACKOFF, increment_base=2,
+                                                 retry_total=STORAGE_RETRY_TOTAL), transport())
+        blob_options.update(TRANSFER_OPTIONS)
+        queue_options = _client_options(QueueRetry(initial_backoff=STORAGE_RETRY_BACKOFF, increment_base=2,
+                                                   retry_total=STORAGE_RETRY_TOTAL), transport())
+        if CLOUD:
+            from azure.identity.aio import DefaultAzureCredential # type: ignore
+            credential = DefaultAzureCredential()
+            stack.push_async_callback(credential.close)
+            blob_service_client = AioBlobServiceClient(account_url=os.environ["STORAGE_BLOB_URL"],
+                                                       credential=credential, **blob_options)
+            queue_service_client = AioQueueServiceClient(account_url=os.environ["STORAGE_QUEUE_URL"],
+                                                         credential=credential, **queue_options)
+        else:
+            blob_service_client = AioBlobServiceClient.from_connection_string(
+                os.environ["STORAGE_CONNECTION_STRING"], **blob_options)
+            queue_service_client = AioQueueServiceClient.from_connection_string(
+                os.environ["STORAGE_CONNECTION_STRING"], **queue_options)
+        yield (await stack.enter_async_context(blob_service_client),
+               await stack.enter_async_context(queue_service_client))
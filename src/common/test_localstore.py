@@ -0,0 +1,108 @@
+"""
+Tests for the local storage backend. Run from the repository root:
+
+    pip install pytest azure-core
+    python -m pytest src/common
+"""
+
+import time
+
+import pytest
+
+pytest.importorskip("azure.core")
+
+from azure.core import MatchConditions
+from azure.core.exceptions import (
+    ResourceExistsError, ResourceModifiedError, ResourceNotFoundError, ResourceNotModifiedError,
+)
+
+from localstore import LocalBlobServiceClient, LocalQueueServiceClient
+
+
+@pytest.fixture
+def container_client(tmp_path):
+    return LocalBlobServiceClient(str(tmp_path)).create_container("test")
+
+
+@pytest.fixture
+def queue_client(tmp_path):
+    return LocalQueueServiceClient(str(tmp_path)).create_queue("test")
+
+
+def test_download_with_current_etag_is_not_modified(container_client):
+    blob_client = container_client.get_blob_client("models/latest.json")
+    etag = blob_client.upload_blob(b"{}")["etag"]
+
+    with pytest.raises(ResourceNotModifiedError) as error:
+        blob_client.download_blob(etag=etag, match_condition=MatchConditions.IfModified)
+    assert error.value.status_code == 304
+
+    # A new version has a new etag and is downloaded
+    blob_client.upload_blob(b'{"version": 2}', overwrite=True)
+    downloader = blob_client.download_blob(etag=etag, match_condition=MatchConditions.IfModified)
+    assert downloader.readall() == b'{"version": 2}'
+    assert downloader.properties.etag != etag
+
+
+def test_upload_with_stale_etag_is_refused(container_client):
+    blob_client = container_client.get_blob_client("models/latest.json")
+    etag = blob_client.upload_blob(b'{"version": 1}')["etag"]
+    blob_client.upload_blob(b'{"version": 2}', overwrite=True)
+
+    with pytest.raises(ResourceModifiedError) as error:
+        blob_client.upload_blob(b'{"version": 0}', overwrite=True, etag=etag,
+                                match_condition=MatchConditions.IfNotModified)
+    assert error.value.status_code == 412
+    assert blob_client.download_blob().readall() == b'{"version": 2}'
+
+
+def test_second_lease_conflicts(container_client):
+    blob_client = container_client.get_blob_client("locks/modeller.lock")
+    blob_client.upload_blob(b"")
+    lease = blob_client.acquire_lease(lease_duration=60)
+
+    with pytest.raises(ResourceExistsError) as error:
+        blob_client.acquire_lease(lease_duration=60)
+    assert error.value.status_code == 409
+
+    # Renewing with the same id works, after the release anyone can take it
+    lease.renew()
+    lease.release()
+    blob_client.acquire_lease(lease_duration=60)
+
+
+def test_received_message_is_hidden_until_its_visibility_timeout(queue_client):
+    queue_client.send_message("flower.jpg")
+
+    (message,) = queue_client.receive_messages(visibility_timeout=0.2)
+    assert message.content == "flower.jpg"
+    assert list(queue_client.receive_messages(visibility_timeout=0.2)) == []
+    assert queue_client.peek_messages() == []
+
+    # Not deleted in time, so another reader can claim it again
+    time.sleep(0.3)
+    (reclaimed,) = queue_client.receive_messages(visibility_timeout=30)
+    assert reclaimed.id == message.id
+    assert reclaimed.pop_receipt != message.pop_receipt
+
+
+def test_delete_with_stale_pop_receipt_fails(queue_client):
+    queue_client.send_message("flower.jpg")
+    (message,) = queue_client.receive_messages(visibility_timeout=0.1)
+    time.sleep(0.2)
+    (reclaimed,) = queue_client.receive_messages(visibility_timeout=30)
+
+    with pytest.raises(ResourceNotFoundError):
+        queue_client.delete_message(message)
+
+    # The reader holding the current receipt can still delete it
+    queue_client.delete_message(reclaimed)
+    assert queue_client.get_queue_properties().approximate_message_count == 0
+
+
+def test_zero_visibility_timeout_leaves_message_visible(queue_client):
+    queue_client.send_message("flower.jpg")
+
+    (message,) = queue_client.receive_messages(visibility_timeout=0)
+    (again,) = queue_client.receive_messages(visibility_timeout=0)
+    assert again.id == message.id
@@ -0,0 +1,154 @@
+import os
+import queue
+import logging
+import threading
+import time
+
+import numpy as np
+
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+# Batching is optional, by default every request runs its own forward pass
+BATCHING_ENABLED = os.environ.get("BATCHING_ENABLED", "false").lower() == "true"
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "16"))
+BATCH_MAX_WAIT_MS = float(os.environ.get("BATCH_MAX_WAIT_MS", "5"))
+BATCH_QUEUE_DEPTH = int(os.environ.get("BATCH_QUEUE_DEPTH", "256"))
+# Longest time a request waits for its batch before giving up
+BATCH_RESULT_TIMEOUT_SECONDS = float(os.environ.get("BATCH_RESULT_TIMEOUT_SECONDS", "30"))
+
+
+class MicroBatcher:
+    """
+    Gathers images from concurrent requests and runs them through the model
+    as one batch. A batch is sent when it reaches max_batch_size or when the
+    first image in it has waited max_wait_ms, whichever comes first.
+
+    predict_fn takes a (N, 224, 224, 3) array and returns (version, probabilities).
+    """
+
+    def __init__(self, predict_fn, max_batch_size: int = BATCH_MAX_SIZE,
+                 max_wait_ms: float = BATCH_MAX_WAIT_MS, queue_depth: int = BATCH_QUEUE_DEPTH,
+                 result_timeout: float = BATCH_RESULT_TIMEOUT_SECONDS):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.result_timeout = result_timeout
+        self._queue = queue.Queue(maxsize=queue_depth)
+        self._stop = threading.Event()
+        self._thread = None
+
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._images = 0
+        self._full_batches = 0
+
+    def submit(self, image):
+        """
+        Queue one formatted image and block until its batch has been predicted.
+        Returns (version, probabilities) for this image only.
+        Raises queue.Full if the queue is at its maximum depth, TimeoutError if
+        the batch is not predicted within result_timeout seconds and
+        RuntimeError if the batcher is not running.
+        """
+        if self._thread is None or self._stop.is_set():
+            raise RuntimeError("The micro-batcher is not running")
+        future = Future()
+        self._queue.put_nowait((image, future))
+        try:
+            return future.result(timeout=self.result_timeout)
+        except FutureTimeoutError:
+            # A cancelled image is dropped when its batch is collected
+            future.cancel()
+            raise TimeoutError(f"No prediction within {self.result_timeout} seconds")
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def stats(self) -> dict:
+        """How many batches have been run and how full they were on average."""
+        with self._stats_lock:
+            mean_size = self._images / self._batches if self._batches else 0.0
+            return {
+                "batches": self._batches,
+                "images": self._images,
+                "full_batches": self._full_batches,
+                "mean_batch_size": mean_size,
+                "mean_fill_ratio": mean_size / self.max_batch_size,
+                "max_batch_size": self.max_batch_size,
+                "max_wait_ms": self.max_wait * 1000.0,
+                "queue_depth": self._queue.qsize(),
+                "queue_capacity": self._queue.maxsize,
+            }
+
+    def _collect(self):
+        # Wait for the first image, then fill the batch until it is full or the window closes
+        try:
+            first = self._queue.get(timeout=0.1)
+        except queue.Empty:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _fail_pending(self):
+        # Fail the images still in the queue so their requests do not wait for the timeout
+        while True:
+            try:
+                _, future = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if future.set_running_or_notify_cancel():
+                future.set_exception(RuntimeError("The micro-batcher has stopped"))
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                self._run_batch()
+        except Exception:
+            logging.exception("The micro-batcher stopped unexpectedly.")
+            self._stop.set()
+        finally:
+            self._fail_pending()
+
+    def _run_batch(self):
+        # Skip images whose requests already timed out
+        batch = [(image, future) for image, future in self._collect() if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+
+        futures = [future for _, future in batch]
+        try:
+            images = np.stack([image for image, _ in batch])
+            version, probabilities = self.predict_fn(images)
+        except Exception as e:
+            logging.exception("Batched prediction failed.")
+            for future in futures:
+                future.set_exception(e)
+            return
+
+        for future, row in zip(futures, probabilities):
+            future.set_result((version, row))
+
+        with self._stats_lock:
+            self._batches += 1
+            self._images += len(batch)
+            if len(batch) == self.max_batch_size:
+                self._full_batches += 1
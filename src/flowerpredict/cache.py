@@ -0,0 +1,86 @@
+import os
+import sys
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+from models import Prediction
+from metrics import CACHE_LOOKUPS
+
+PREDICTION_CACHE_ENABLED = os.environ.get("PREDICTION_CACHE_ENABLED", "true").lower() == "true"
+PREDICTION_CACHE_ENTRIES = int(os.environ.get("PREDICTION_CACHE_ENTRIES", "4096"))
+PREDICTION_CACHE_BYTES = int(os.environ.get("PREDICTION_CACHE_BYTES", str(8 * 1024 * 1024)))
+
+
+def image_digest(image_bytes: bytes) -> str:
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+class PredictionCache:
+    """
+    Bounded LRU cache of predictions keyed by (image digest, model version).
+    The cache is limited both by the number of entries and by an approximate
+    memory size, and the oldest entries are evicted first.
+    """
+
+    def __init__(self, max_entries: int = PREDICTION_CACHE_ENTRIES, max_bytes: int = PREDICTION_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _size(key, prediction: Prediction) -> int:
+        return sys.getsizeof(key[0]) + sys.getsizeof(prediction) + sys.getsizeof(prediction.prediction) + 64
+
+    def get(self, digest: str, version: int):
+        key = (digest, version)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                CACHE_LOOKUPS.labels(result="miss").inc()
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            CACHE_LOOKUPS.labels(result="hit").inc()
+            return entry[0]
+
+    def put(self, digest: str, version: int, prediction: Prediction):
+        key = (digest, version)
+        size = self._size(key, prediction)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (prediction, size)
+            self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self, *args):
+        """Drop all entries, e.g. when a new model version is activated."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
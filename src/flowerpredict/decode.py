@@ -0,0 +1,65 @@
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from fastapi import UploadFile, HTTPException
+
+IMAGE_RES = 224
+
+# Largest accepted upload for /predict, in bytes
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+READ_CHUNK_BYTES = 64 * 1024
+
+
+def read_upload(image_file: UploadFile, max_bytes: int = MAX_UPLOAD_BYTES) -> bytes:
+    """
+    Read the upload in chunks and stop as soon as it is larger than max_bytes,
+    instead of reading an arbitrarily large body into memory.
+    """
+    data = bytearray()
+    while True:
+        chunk = image_file.file.read(READ_CHUNK_BYTES)
+        if not chunk:
+            return bytes(data)
+        data += chunk
+        if len(data) > max_bytes:
+            raise HTTPException(status_code=413, detail=f"Image is larger than {max_bytes} bytes")
+
+
+def decode_jpeg_scaled(image_bytes):
+    """
+    Let the JPEG decoder scale the image down by 1/2, 1/4 or 1/8 in the DCT
+    domain while decoding, so a 12 MP phone photo is decoded at roughly
+    500 px instead of at full size. The largest ratio that still leaves
+    both sides at least 224 px is used.
+    """
+    shape = tf.io.extract_jpeg_shape(image_bytes)
+    smallest_side = tf.minimum(shape[0], shape[1])
+    branches = [
+        (smallest_side >= IMAGE_RES * ratio,
+         lambda ratio=ratio: tf.io.decode_jpeg(image_bytes, channels=3, ratio=ratio))
+        for ratio in (8, 4, 2)
+    ]
+    return tf.case(branches, default=lambda: tf.io.decode_jpeg(image_bytes, channels=3))
+
+
+def decode_and_format(image_bytes):
+    """
+    Decode a JPEG into a normalized (224, 224, 3) float32 tensor. /predict and
+    /predict/batch both decode with this, so an image gets the same pixels,
+    and the same cached prediction, whichever endpoint it came through.
+    """
+    image = tf.cast(decode_jpeg_scaled(image_bytes), tf.float32)
+    return tf.image.resize(image, (IMAGE_RES, IMAGE_RES))/255.0
+
+
+def decode_image(image_bytes: bytes) -> np.ndarray:
+    """Decode a single upload with decode_and_format, for /predict."""
+    # Every JPEG starts with the SOI marker
+    if not image_bytes.startswith(b"\xff\xd8"):
+        raise HTTPException(status_code=400, detail="Only JPEG files ar allowed")
+    try:
+        return decode_and_format(tf.constant(image_bytes)).numpy()
+    except tf.errors.InvalidArgumentError:
+        raise HTTPException(status_code=400, detail="Could not decode the image")
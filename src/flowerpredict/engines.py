@@ -0,0 +1,114 @@
+import os
+import logging
+import threading
+
+from typing import Optional
+
+import numpy as np
+import tensorflow as tf
+
+from delta import apply_delta
+from metrics import STAGE_SECONDS
+
+# Which inference engine to use: "keras" (default) or "tflite".
+# "tflite" falls back to "keras" when a model version has no TFLite artifact.
+INFERENCE_ENGINE = os.environ.get("INFERENCE_ENGINE", "keras").lower()
+
+# Thread pools per worker process, 0 lets TensorFlow decide.
+# With several workers set these so that workers * intra-op threads ~= number of cores.
+TF_INTRA_OP_THREADS = int(os.environ.get("TF_INTRA_OP_THREADS", "0"))
+TF_INTER_OP_THREADS = int(os.environ.get("TF_INTER_OP_THREADS", "0"))
+
+# This has to happen before TensorFlow runs its first operation
+if TF_INTRA_OP_THREADS:
+    tf.config.threading.set_intra_op_parallelism_threads(TF_INTRA_OP_THREADS)
+if TF_INTER_OP_THREADS:
+    tf.config.threading.set_inter_op_parallelism_threads(TF_INTER_OP_THREADS)
+
+
+class KerasEngine:
+    """
+    Runs the full .keras model. The weights are copied into every worker
+    process, use the tflite engine to share them between workers.
+    If delta_path is given, the weights changed since the base model are
+    applied on top of the model in model_path.
+    """
+
+    name = "keras"
+
+    def __init__(self, model_path: str, delta_path: Optional[str] = None):
+        self.model_path = model_path
+        self.delta_path = delta_path
+        with STAGE_SECONDS.labels("model_load").time():
+            self.model = tf.keras.models.load_model(model_path)
+            if delta_path is not None:
+                apply_delta(self.model, delta_path)
+
+    def predict(self, images) -> np.ndarray:
+        return np.asarray(self.model(images, training=False))
+
+
+class TFLiteEngine:
+    """
+    Runs the quantized .tflite model published by the modeller. The model
+    file is memory-mapped from local disk, so all worker processes share one
+    read-only copy of the weights through the page cache. The interpreter
+    is not thread safe, so calls are serialized with a lock.
+    """
+
+    name = "tflite"
+    delta_path = None
+
+    def __init__(self, model_path: str):
+        self.model_path = model_path
+        with STAGE_SECONDS.labels("model_load").time():
+            self._interpreter = tf.lite.Interpreter(
+                model_path=model_path,
+                num_threads=TF_INTRA_OP_THREADS or None,
+            )
+        self._input_index = self._interpreter.get_input_details()[0]["index"]
+        self._output_index = self._interpreter.get_output_details()[0]["index"]
+        self._batch_size = None
+        self._lock = threading.Lock()
+
+    def predict(self, images) -> np.ndarray:
+        images = np.asarray(images, dtype=np.float32)
+        with self._lock:
+            # Resizing reallocates the tensors, so only do it when the batch size changes
+            if images.shape[0] != self._batch_size:
+                self._interpreter.resize_tensor_input(self._input_index, images.shape)
+                self._interpreter.allocate_tensors()
+                self._batch_size = images.shape[0]
+            self._interpreter.set_tensor(self._input_index, images)
+            self._interpreter.invoke()
+            return self._interpreter.get_tensor(self._output_index).copy()
+
+
+def warm_up(engine, batch_sizes):
+    """
+    Run dummy 224x224 batches through a freshly loaded engine, so the first
+    real request does not pay for graph building and memory allocation.
+    """
+    for batch_size in batch_sizes:
+        engine.predict(np.zeros((batch_size, 224, 224, 3), dtype=np.float32))
+
+
+def load_engine(manifest, version: int, fetch_blob):
+    """
+    Build the configured inference engine for a model version.
+    fetch_blob(blob_name) returns the path of a local copy of the blob.
+    """
+    current = manifest if (manifest or {}).get("version") == version else {}
+    tflite = current.get("tflite")
+    if INFERENCE_ENGINE == "tflite":
+        if tflite is not None:
+            try:
+                return TFLiteEngine(fetch_blob(tflite["blob_name"]))
+            except Exception:
+                logging.exception(f"Could not load the TFLite model for version {version}, using Keras.")
+        else:
+            logging.warning(f"No TFLite model published for version {version}, using Keras.")
+    delta = current.get("delta")
+    if delta is not None:
+        return KerasEngine(fetch_blob(current["blob_name"]), fetch_blob(delta["blob_name"]))
+    return KerasEngine(fetch_blob(f"models/flowers_{version}.keras"))
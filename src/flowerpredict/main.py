@@ -1,22 +1,68 @@
 import os
+import time
+import queue
 import logging
+import shutil
 import tempfile
+import threading
+import zipfile
+import zlib
 
-from io import BytesIO
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from datetime import datetime
-from sklearn.linear_model import LogisticRegression
+import numpy as np
 
+from typing import List
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
+from fastapi.responses import StreamingResponse, JSONResponse, Response
+from datetime import datetime
+from io import BytesIO
+from PIL import Image
+from starlette.datastructures import Headers
+from starlette.routing import Match
 
 import tensorflow as tf
-from models import Prediction
-from utils import latest_model_version, load_model
+from models import Prediction, BatchPrediction
+from registry import registry
+from batcher import MicroBatcher, BATCHING_ENABLED
+from cache import PredictionCache, PREDICTION_CACHE_ENABLED, image_digest
+from decode import MAX_UPLOAD_BYTES, read_upload, decode_image, decode_and_format
+from metrics import REQUESTS, ERRORS, REQUEST_SECONDS, STAGE_SECONDS, BATCH_SIZE, latest_metrics
 
 IMAGE_RES = 224
+FLOWER_LIST = ['dandelion', 'daisy', 'tulips', 'sunflowers', 'roses']
+JPEG_TYPES = ("image/jpeg", "image/jpg")
+ZIP_TYPES = ("application/zip", "application/x-zip-compressed")
+
+# Images per forward pass in /predict/batch
+PREDICT_BATCH_CHUNK = int(os.environ.get("PREDICT_BATCH_CHUNK", "64"))
+# Uploads with more images than this are streamed back as NDJSON
+PREDICT_BATCH_STREAM_THRESHOLD = int(os.environ.get("PREDICT_BATCH_STREAM_THRESHOLD", "256"))
+# Limits for one /predict/batch request, counted after unzipping
+PREDICT_BATCH_MAX_IMAGES = int(os.environ.get("PREDICT_BATCH_MAX_IMAGES", "10000"))
+PREDICT_BATCH_MAX_BYTES = int(os.environ.get("PREDICT_BATCH_MAX_BYTES", str(2 * 1024 * 1024 * 1024)))
+# Largest raw request body for /predict/batch, the images plus room for multipart and zip headers
+PREDICT_BATCH_MAX_BODY_BYTES = int(os.environ.get("PREDICT_BATCH_MAX_BODY_BYTES",
+                                                  str(PREDICT_BATCH_MAX_BYTES + 16 * 1024 * 1024)))
 
-def format_image(image):
-    image = tf.image.resize(image, (IMAGE_RES, IMAGE_RES))/255.0
-    return image
+def decode_batch(images_bytes: list):
+    """
+    Decode and resize a list of JPEG bytes into one (N, 224, 224, 3) tensor.
+    The decodes run in parallel inside tf.data.
+    """
+    dataset = tf.data.Dataset.from_tensor_slices(tf.constant(images_bytes, dtype=tf.string))
+    dataset = dataset.map(decode_and_format, num_parallel_calls=tf.data.AUTOTUNE)
+    with STAGE_SECONDS.labels("decode").time():
+        return next(iter(dataset.batch(len(images_bytes))))
+
+def decode_each(images_bytes: list) -> list:
+    """Decode the images one at a time. Images that cannot be decoded are returned as None."""
+    images = []
+    with STAGE_SECONDS.labels("decode").time():
+        for image_bytes in images_bytes:
+            try:
+                images.append(decode_and_format(tf.constant(image_bytes)))
+            except tf.errors.InvalidArgumentError:
+                images.append(None)
+    return images
 
 # Set the logging level for this script
 logging.basicConfig(level=logging.INFO)
@@ -25,51 +71,398 @@ logging.basicConfig(level=logging.INFO)
 azure_logger = logging.getLogger('azure')
 azure_logger.setLevel(logging.WARNING)
 
+
+def run_model(images):
+    """
+    Run one forward pass over a batch of formatted images.
+    Returns the model version used and the softmax probabilities.
+    """
+    version, engine = registry.get()
+    BATCH_SIZE.observe(len(images))
+    with STAGE_SECONDS.labels("forward").time():
+        output = engine.predict(images)
+    return version, tf.nn.softmax(output).numpy()
+
+
+def to_prediction(version: int, probabilities) -> Prediction:
+    # Select the most probable flower label
+    output_index = int(np.argmax(probabilities))
+    return Prediction(
+        label=output_index,
+        confidence=float(probabilities[output_index]),
+        prediction=FLOWER_LIST[output_index],
+        version=version,
+        version_iso=datetime.fromtimestamp(version).isoformat()
+    )
+
+
+# Concurrent requests share forward passes when batching is enabled
+batcher = MicroBatcher(run_model) if BATCHING_ENABLED else None
+
+# Repeated uploads of the same image are answered from the cache
+prediction_cache = PredictionCache() if PREDICTION_CACHE_ENABLED else None
+if prediction_cache is not None:
+    registry.add_listener(prediction_cache.clear)
+
 app = FastAPI()
 
+
+def endpoint_label(request: Request) -> str:
+    # Use the route template as the label so unknown paths do not create new series
+    route = request.scope.get("route")
+    if route is not None:
+        return route.path
+    # Requests rejected by a middleware never reach the router
+    for route in app.routes:
+        if route.matches(request.scope)[0] == Match.FULL:
+            return route.path
+    return "other"
+
+
+class LimitUploadSize:
+    """
+    Reject request bodies larger than max_bytes on the given paths with 413.
+    Content-Length is checked before the body is read, and bodies without it
+    (chunked transfer encoding) are counted while they are received.
+    """
+
+    def __init__(self, app, max_bytes: int = MAX_UPLOAD_BYTES, paths: tuple = ("/predict",), what: str = "Image"):
+        self.app = app
+        self.max_bytes = max_bytes
+        self.paths = paths
+        self.detail = f"{what} is larger than {max_bytes} bytes"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            return await self.app(scope, receive, send)
+
+        content_length = Headers(scope=scope).get("content-length")
+        if content_length is not None:
+            if not content_length.isdigit():
+                response = JSONResponse(status_code=400, content={"detail": "Invalid Content-Length header"})
+                return await response(scope, receive, send)
+            if int(content_length) > self.max_bytes:
+                response = JSONResponse(status_code=413, content={"detail": self.detail})
+                return await response(scope, receive, send)
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                # Raised while the form is parsed, so FastAPI answers with the 413
+                if received > self.max_bytes:
+                    raise HTTPException(status_code=413, detail=self.detail)
+            return message
+
+        await self.app(scope, limited_receive, send)
+
+
+app.add_middleware(LimitUploadSize)
+# Bounds what Starlette spools to disk before spool_uploads() checks the images
+app.add_middleware(LimitUploadSize, max_bytes=PREDICT_BATCH_MAX_BODY_BYTES, paths=("/predict/batch",), what="Upload")
+
+
+# Registered last so it is the outermost middleware and also counts the 413s
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        return response
+    except Exception:
+        ERRORS.labels(endpoint=endpoint_label(request)).inc()
+        raise
+    finally:
+        endpoint = endpoint_label(request)
+        REQUEST_SECONDS.labels(endpoint=endpoint).observe(time.perf_counter() - start)
+        REQUESTS.labels(endpoint=endpoint, status=status).inc()
+
+
+# Set once the model is loaded and the whole prediction path has been run once
+ready = threading.Event()
+
+
+def warm_up_service():
+    """
+    Load the current model and run a dummy image through decode and predict,
+    so the first real request does not pay for the cold start.
+    """
+    start = time.perf_counter()
+    while not registry.loaded:
+        try:
+            registry.get()
+        except Exception:
+            logging.exception("Loading the model failed, retrying in 5 seconds.")
+            time.sleep(5)
+
+    with BytesIO() as data:
+        Image.new("RGB", (IMAGE_RES, IMAGE_RES)).save(data, format="JPEG")
+        dummy_jpeg = data.getvalue()
+    run_model(np.expand_dims(decode_image(dummy_jpeg), axis=0))
+    run_model(decode_batch([dummy_jpeg]))
+
+    ready.set()
+    logging.info(f"Service ready in {time.perf_counter() - start:.1f} s.")
+
+
+@app.on_event("startup")
+def start_registry():
+    # Warm up in the background so the health endpoints answer meanwhile
+    threading.Thread(target=warm_up_service, name="warm-up", daemon=True).start()
+    # Watch for new model versions in the background
+    registry.start()
+    if batcher is not None:
+        batcher.start()
+
+
+@app.on_event("shutdown")
+def stop_registry():
+    if batcher is not None:
+        batcher.stop()
+    registry.stop()
+
+
+@app.get("/health")
+def health() -> dict:
+    """Liveness: the process is up."""
+    return {"status": "ok"}
+
+
+@app.get("/ready")
+def readiness():
+    """Readiness: the model is loaded and warmed up."""
+    if not ready.is_set():
+        return JSONResponse(status_code=503, content={"ready": False})
+    return {"ready": True, "version": registry.get()[0]}
+
+
 @app.post("/predict")
 def predict_hello(image_file: UploadFile = File(...)) -> Prediction:
 
     # Check the MIME type
-    if image_file.content_type not in ("image/jpeg", "image/jpg"):
+    if image_file.content_type not in JPEG_TYPES:
         raise HTTPException(status_code=400, detail="Only JPEG files ar allowed")
 
-    # Load .keras model
-    latest_version = latest_model_version()
-    logging.info(f"Latest version: {latest_version}")
-    model_bytes = load_model(latest_version)
+    # Load image_file
+    with STAGE_SECONDS.labels("read_upload").time():
+        image_bytes = read_upload(image_file)
 
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".keras") as temp_file:
-        temp_file.write(model_bytes)
-        temp_file_path = temp_file.name
-    
-    model = tf.keras.models.load_model(temp_file_path)
-    logging.info(f"Model: {model.summary(show_trainable=True)}")
+    # Return the cached prediction if this image was already predicted with the active model
+    if prediction_cache is not None:
+        digest = image_digest(image_bytes)
+        cached = prediction_cache.get(digest, registry.get()[0])
+        if cached is not None:
+            return cached
 
-    # Load image_file
-    image_bytes = image_file.file.read()
-    test_image = tf.keras.utils.load_img(BytesIO(image_bytes), target_size=(IMAGE_RES, IMAGE_RES))
-    test_image = tf.keras.utils.img_to_array(test_image)
-    test_image = format_image(test_image)
+    with STAGE_SECONDS.labels("decode").time():
+        test_image = decode_image(image_bytes)
 
-    # Predict the image
-    output = model.predict(tf.expand_dims(test_image, axis = 0), batch_size=1)
+    # Predict the image, either alone or as part of a micro-batch
+    if batcher is not None:
+        try:
+            latest_version, output = batcher.submit(test_image)
+        except queue.Full:
+            raise HTTPException(status_code=503, detail="Prediction queue is full, try again later")
+        except (TimeoutError, RuntimeError) as e:
+            raise HTTPException(status_code=503, detail=str(e))
+    else:
+        latest_version, output = run_model(np.expand_dims(test_image, axis = 0))
+        output = output[0]
     logging.info(f"Output: {output}")
 
-    # Calculate prediction probability & select corresponding flower label
-    output = tf.nn.softmax(output)
-    logging.info(f"Output: {output}")
-    output_index = tf.argmax(output, axis=1).numpy()[0]
-    flower_list = ['dandelion', 'daisy', 'tulips', 'sunflowers', 'roses']
-    prediction = flower_list[int(output_index)]
-    logging.info(f"Output: {output}")
+    prediction = to_prediction(latest_version, output)
+    if prediction_cache is not None:
+        prediction_cache.put(digest, latest_version, prediction)
+    return prediction
 
-    return Prediction(
-        label=int(output_index),
-        confidence=float(output[0][int(output_index)]),
-        prediction=prediction,
-        version=latest_version,
-        version_iso=datetime.fromtimestamp(latest_version).isoformat()
 
-    )    
+def image_members(archive: zipfile.ZipFile) -> list:
+    # JPEG files in a zip archive
+    return [info for info in archive.infolist()
+            if not info.is_dir() and info.filename.lower().endswith((".jpg", ".jpeg"))]
+
+
+def spool_uploads(files: List[UploadFile]):
+    """
+    Copy the uploads to temporary files owned by us, so they stay readable
+    while a streaming response is still being produced.
+    Returns the spooled files and the number of images they contain.
+    Zip archives are checked against the batch limits using the sizes in
+    their directory, before anything is decompressed.
+    """
+    spooled = []
+    n_images = 0
+    n_bytes = 0
+    try:
+        for upload in files:
+            if upload.content_type not in JPEG_TYPES + ZIP_TYPES:
+                raise HTTPException(status_code=400, detail=f"{upload.filename}: only JPEG and zip files are allowed")
+            file = tempfile.TemporaryFile()
+            spooled.append((upload.filename, upload.content_type, file))
+            shutil.copyfileobj(upload.file, file)
+            size = file.tell()
+            file.seek(0)
+
+            if upload.content_type in ZIP_TYPES:
+                try:
+                    with zipfile.ZipFile(file) as archive:
+                        members = image_members(archive)
+                except zipfile.BadZipFile:
+                    raise HTTPException(status_code=400, detail=f"{upload.filename}: not a valid zip archive")
+                n_images += len(members)
+                # Oversized members are reported as errors without being decompressed
+                n_bytes += sum(info.file_size for info in members if info.file_size <= MAX_UPLOAD_BYTES)
+                file.seek(0)
+            else:
+                n_images += 1
+                n_bytes += min(size, MAX_UPLOAD_BYTES)
+
+            if n_images > PREDICT_BATCH_MAX_IMAGES:
+                raise HTTPException(status_code=413, detail=f"More than {PREDICT_BATCH_MAX_IMAGES} images in one request")
+            if n_bytes > PREDICT_BATCH_MAX_BYTES:
+                raise HTTPException(status_code=413, detail=f"Images are larger than {PREDICT_BATCH_MAX_BYTES} bytes in total")
+    except HTTPException:
+        for _, _, file in spooled:
+            file.close()
+        raise
+    return spooled, n_images
+
+
+def iter_uploaded_images(spooled):
+    # Yield (filename, JPEG bytes, error) from plain JPEG uploads and from zip archives
+    too_large = f"Image is larger than {MAX_UPLOAD_BYTES} bytes"
+    for filename, content_type, file in spooled:
+        if content_type in ZIP_TYPES:
+            with zipfile.ZipFile(file) as archive:
+                for info in image_members(archive):
+                    # zipfile stops reading a member at its declared file_size
+                    if info.file_size > MAX_UPLOAD_BYTES:
+                        yield info.filename, None, too_large
+                        continue
+                    try:
+                        data = archive.read(info)
+                    except (zipfile.BadZipFile, zlib.error, NotImplementedError, RuntimeError) as e:
+                        yield info.filename, None, f"Could not read the file from the archive: {e}"
+                        continue
+                    yield info.filename, data, None
+        else:
+            data = file.read(MAX_UPLOAD_BYTES + 1)
+            if len(data) > MAX_UPLOAD_BYTES:
+                yield filename, None, too_large
+            else:
+                yield filename, data, None
+
+
+def predict_chunk(chunk):
+    """
+    Predict one chunk of (filename, JPEG bytes, error) items.
+    Images that cannot be read or decoded get a result with only error set.
+    """
+    errors = {}
+    for index, (name, data, error) in enumerate(chunk):
+        if error is None and data[:2] != b"\xff\xd8":
+            error = "Not a JPEG image"
+        if error is not None:
+            logging.warning(f"Skipping {name}: {error}")
+            errors[index] = error
+
+    # Only decode and predict the images that are not cached
+    predictions = {}
+    misses = []
+    version = registry.get()[0]
+    for index, (name, data, _) in enumerate(chunk):
+        if index in errors:
+            continue
+        digest = image_digest(data) if prediction_cache is not None else None
+        cached = prediction_cache.get(digest, version) if prediction_cache is not None else None
+        if cached is not None:
+            predictions[index] = cached
+        else:
+            misses.append((index, digest, data))
+
+    if misses:
+        try:
+            images = decode_batch([data for _, _, data in misses])
+        except tf.errors.InvalidArgumentError:
+            # One broken image fails the whole tf.data batch, so decode them one by one
+            decoded = decode_each([data for _, _, data in misses])
+            for (index, _, _), image in zip(misses, decoded):
+                if image is None:
+                    logging.warning(f"Skipping {chunk[index][0]}: could not decode the image")
+                    errors[index] = "Could not decode the image"
+            misses = [miss for miss, image in zip(misses, decoded) if image is not None]
+            images = tf.stack([image for image in decoded if image is not None]) if misses else None
+
+    if misses:
+        version, probabilities = run_model(images)
+        for (index, digest, _), row in zip(misses, probabilities):
+            predictions[index] = to_prediction(version, row)
+            if prediction_cache is not None:
+                prediction_cache.put(digest, version, predictions[index])
+
+    for index, (name, _, _) in enumerate(chunk):
+        if index in errors:
+            yield BatchPrediction(filename=name, error=errors[index])
+        else:
+            yield BatchPrediction(filename=name, **predictions[index].model_dump())
+
+
+def predict_uploads(spooled):
+    """Predict the uploaded images PREDICT_BATCH_CHUNK at a time."""
+    try:
+        chunk = []
+        for item in iter_uploaded_images(spooled):
+            chunk.append(item)
+            if len(chunk) == PREDICT_BATCH_CHUNK:
+                yield from predict_chunk(chunk)
+                chunk = []
+        if chunk:
+            yield from predict_chunk(chunk)
+    finally:
+        for _, _, file in spooled:
+            file.close()
+
+
+@app.post("/predict/batch", response_model=List[BatchPrediction])
+def predict_batch(files: List[UploadFile] = File(...), stream: bool = False):
+    """
+    Predict many JPEG images, or zip archives of JPEG images, in one request.
+    Large uploads (or stream=true) are answered with one JSON object per line.
+    Images that cannot be predicted get a result with the error field set.
+    """
+    spooled, n_images = spool_uploads(files)
+    logging.info(f"Batch prediction for {n_images} images")
+
+    if stream or n_images > PREDICT_BATCH_STREAM_THRESHOLD:
+        lines = (prediction.model_dump_json() + "\n" for prediction in predict_uploads(spooled))
+        return StreamingResponse(lines, media_type="application/x-ndjson")
+
+    return list(predict_uploads(spooled))
+
+
+@app.get("/metrics")
+def metrics():
+    """Prometheus metrics."""
+    data, content_type = latest_metrics()
+    return Response(content=data, media_type=content_type)
+
+
+@app.get("/cache")
+def cache_stats() -> dict:
+    """Report prediction cache hits and misses."""
+    if prediction_cache is None:
+        return {"enabled": False}
+    return {"enabled": True, **prediction_cache.stats()}
+
 
+@app.get("/batching")
+def batching_stats() -> dict:
+    """Report how full the micro-batches are."""
+    if batcher is None:
+        return {"enabled": False}
+    return {"enabled": True, **batcher.stats()}
@@ -0,0 +1,71 @@
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Latency buckets from 1 ms to 30 s
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+REQUESTS = Counter(
+    "flowerpredict_requests_total",
+    "HTTP requests by endpoint and status code.",
+    ["endpoint", "status"],
+)
+ERRORS = Counter(
+    "flowerpredict_errors_total",
+    "Requests that failed with an unhandled exception.",
+    ["endpoint"],
+)
+REQUEST_SECONDS = Histogram(
+    "flowerpredict_request_seconds",
+    "Request latency by endpoint.",
+    ["endpoint"],
+    buckets=LATENCY_BUCKETS,
+)
+# Stages: manifest_check, list_models, model_download, model_load, read_upload, decode, forward
+STAGE_SECONDS = Histogram(
+    "flowerpredict_stage_seconds",
+    "Latency of the individual prediction and storage stages.",
+    ["stage"],
+    buckets=LATENCY_BUCKETS,
+)
+MODEL_VERSION = Gauge(
+    "flowerpredict_model_version",
+    "Active model version (Unix timestamp).",
+    multiprocess_mode="max",
+)
+MODEL_ACTIVATIONS = Counter(
+    "flowerpredict_model_activations_total",
+    "Model versions loaded and activated, by engine.",
+    ["engine"],
+)
+CACHE_LOOKUPS = Counter(
+    "flowerpredict_cache_lookups_total",
+    "Prediction cache lookups by result (hit or miss).",
+    ["result"],
+)
+BATCH_SIZE = Histogram(
+    "flowerpredict_batch_size",
+    "Number of images per forward pass.",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+
+
+def latest_metrics():
+    """
+    Return the metrics in Prometheus text format. With several uvicorn
+    workers PROMETHEUS_MULTIPROC_DIR is set and the values of all worker
+    processes are combined.
+    """
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -1,3 +1,4 @@
+from typing import Optional
 from pydantic import BaseModel
 
 class Prediction(BaseModel):
@@ -6,3 +7,13 @@ class Prediction(BaseModel):
     prediction: str
     version: int
     version_iso: str
+
+class BatchPrediction(BaseModel):
+    # Either the prediction fields or error is set
+    filename: str
+    label: Optional[int] = None
+    confidence: Optional[float] = None
+    prediction: Optional[str] = None
+    version: Optional[int] = None
+    version_iso: Optional[str] = None
+    error: Optional[str] = None
@@ -0,0 +1,121 @@
+import os
+import logging
+import threading
+
+from engines import load_engine, warm_up
+from metrics import MODEL_VERSION, MODEL_ACTIVATIONS
+from utils import latest_model_version, fetch_blob, prune_model_cache, read_manifest
+
+# How often (in seconds) the background thread checks for a newer model version
+MODEL_POLL_SECONDS = float(os.environ.get("MODEL_POLL_SECONDS", "30"))
+# Batch sizes run through every new model before it starts serving requests
+WARMUP_BATCH_SIZES = [int(n) for n in os.environ.get("WARMUP_BATCH_SIZES", "1").split(",")]
+
+
+class ModelRegistry:
+    """
+    Keeps the loaded inference engine resident in the process. A background
+    thread polls for new versions and swaps the active engine in one
+    assignment, so requests always see a complete (version, engine) pair.
+    """
+
+    def __init__(self, poll_seconds: float = MODEL_POLL_SECONDS, warmup_batch_sizes=WARMUP_BATCH_SIZES):
+        self.poll_seconds = poll_seconds
+        self.warmup_batch_sizes = warmup_batch_sizes
+        self._active = None
+        self._published_version = None
+        self._manifest = None
+        self._manifest_etag = None
+        self._listeners = []
+        self._load_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def get(self):
+        """
+        Return the active (version, engine) pair, loading the latest model if
+        nothing has been loaded yet.
+        """
+        active = self._active
+        if active is None:
+            self.refresh()
+            active = self._active
+        return active
+
+    @property
+    def loaded(self) -> bool:
+        return self._active is not None
+
+    def add_listener(self, callback):
+        """Call callback(version) every time a new model version is activated."""
+        self._listeners.append(callback)
+
+    def published_version(self) -> int:
+        """
+        Newest published model version. The manifest is fetched with a
+        conditional request, so an unchanged manifest costs one 304 response
+        no matter how many models are stored. Without a manifest the model
+        blobs are listed as before.
+        """
+        manifest, etag = read_manifest(self._manifest_etag)
+        if manifest is not None:
+            self._manifest = manifest
+            self._published_version = int(manifest["version"])
+        elif etag is None:
+            self._published_version = latest_model_version()
+        self._manifest_etag = etag
+        return self._published_version
+
+    def refresh(self) -> bool:
+        """
+        Load the latest model version if it is newer than the active one.
+        Returns True if a new model was activated.
+        """
+        version = self.published_version()
+        # Only move forward, an older manifest is never switched back to
+        if self._active is not None and version <= self._active[0]:
+            return False
+
+        # Only one thread loads at a time, the others keep serving the old model
+        with self._load_lock:
+            if self._active is not None and version <= self._active[0]:
+                return False
+            engine = load_engine(self._manifest, version, fetch_blob)
+            # Warm the new model up before it replaces the old one
+            warm_up(engine, self.warmup_batch_sizes)
+            self._active = (version, engine)
+            prune_model_cache({os.path.basename(path) for path in (engine.model_path, engine.delta_path) if path}, version)
+
+        logging.info(f"Activated model version {version} ({engine.name}).")
+        MODEL_VERSION.set(version)
+        MODEL_ACTIVATIONS.labels(engine=engine.name).inc()
+        for callback in self._listeners:
+            callback(version)
+        return True
+
+    def start(self):
+        """Start the background thread that watches for new model versions."""
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name="model-registry", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _watch(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                # Keep serving the current model if storage is temporarily unavailable
+                logging.exception("Model refresh failed, keeping the active model.")
+            if self._stop.wait(self.poll_seconds):
+                return
+
+
+registry = ModelRegistry()
@@ -1,34 +1,43 @@
-import zlib
-import numpy as np
+import re
+import json
+import fcntl
 import os
 import logging
-from tensorflow.keras.models import load_model
-import tensorflow as tf
 
 
-from io import BytesIO
-from azure.storage.blob import BlobServiceClient
-from base64 import b64decode, b64encode
-from PIL import Image
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotFoundError, ResourceNotModifiedError
 from datetime import datetime
-from functools import lru_cache
+from typing import Optional, Tuple
 
-# Are we running in the cloud?
-CLOUD = os.environ.get("USE_AZURE_CREDENTIAL", "false").lower() == "true"
+from metrics import STAGE_SECONDS
+from storage import get_container_client, download_to_file, blob_path
 
+# Small blob published by the modeller that always points to the newest model
+MANIFEST_BLOB = "models/latest.json"
 
-def get_blob_service_client():
+# Local directory for downloaded model files, shared by all workers in the container
+MODEL_CACHE_DIR = os.environ.get("MODEL_CACHE_DIR", "/tmp/flowerpredict-models")
+
+def read_manifest(etag: Optional[str] = None) -> Tuple[Optional[dict], Optional[str]]:
     """
-    The STORAGE_CONNECTION_STRING is only set up when running in the cloud. 
-    If it's not set, we're running locally with Azurite.
+    Read the model manifest with a conditional request. If the manifest still
+    has the given etag the storage answers 304 and (None, etag) is returned
+    without downloading anything. Returns (None, None) if there is no manifest.
     """
-    if CLOUD:
-        from azure.identity import DefaultAzureCredential # type: ignore
-        credential = DefaultAzureCredential()
-        account_url = os.environ["STORAGE_BLOB_URL"]
-        return BlobServiceClient(account_url=account_url, credential=credential)
-    else:
-        return BlobServiceClient.from_connection_string(os.environ["STORAGE_CONNECTION_STRING"])
+    with STAGE_SECONDS.labels("manifest_check").time():
+        blob_client = get_container_client().get_blob_client(MANIFEST_BLOB)
+        try:
+            if etag is None:
+                downloader = blob_client.download_blob()
+            else:
+                downloader = blob_client.download_blob(etag=etag, match_condition=MatchConditions.IfModified)
+            manifest = json.loads(downloader.readall())
+            return manifest, downloader.properties.etag
+        except ResourceNotModifiedError:
+            return None, etag
+        except ResourceNotFoundError:
+            return None, None
 
 
 def latest_model_version() -> int:
@@ -36,13 +45,14 @@ def latest_model_version() -> int:
     Retrieve the latest model version based on the Unix timestamp in the model file name.
     If no Unix-formatted models are found, default to 'flowers_1.keras'.
     """
-    with get_blob_service_client() as blob_service_client:
-        container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
-        blobs = container_client.list_blobs(name_starts_with="models/")
+    with STAGE_SECONDS.labels("list_models").time():
+        blobs = get_container_client().list_blobs(name_starts_with="models/")
 
         model_versions = []
 
         for blob in blobs:
+            if not blob.name.endswith(".keras"):
+                continue
             try:
                 # Attempt to extract the Unix timestamp from the model name
                 version = int(blob.name.split("_")[1].split(".")[0])
@@ -60,16 +70,57 @@ def latest_model_version() -> int:
             logging.info("No Unix-formatted model found, defaulting to flowers_1.keras")
             return 1
 
-@lru_cache(maxsize=5)
-def load_model(version:int):
-    # Find the latest model from /models folder in the storage container
-    # The model name follows the pattern model_{unix_seconds}.keras
-    with get_blob_service_client() as blob_service_client:
-        container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
-        blob_client = container_client.get_blob_client(f"models/flowers_{version}.keras")
-        logging.info(f"Loading model version {version}.")
-
-        with BytesIO() as data:
-            blob_client.download_blob().readinto(data)
-            data.seek(0)
-            return data.read()
+
+def fetch_blob(blob_name: str) -> str:
+    """
+    Download a model file into MODEL_CACHE_DIR and return the local path.
+    Model files never change once published, so a file that already exists
+    is reused. The workers take a file lock, so only one of them downloads
+    while the others wait and then reuse the same file. With the local
+    storage backend the blob's own file is used and nothing is copied.
+    """
+    if (path := blob_path(blob_name)) is not None:
+        return path
+
+    os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+    path = os.path.join(MODEL_CACHE_DIR, os.path.basename(blob_name))
+
+    with open(path + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if os.path.exists(path):
+            return path
+
+        # Write to a temporary name first so a half-written file is never loaded
+        temp_path = f"{path}.{os.getpid()}.part"
+        with STAGE_SECONDS.labels("model_download").time():
+            logging.info(f"Downloading {blob_name} to {path}.")
+            with open(temp_path, "wb") as f:
+                download_to_file(blob_name, f)
+        os.replace(temp_path, path)
+    return path
+
+
+def prune_model_cache(keep: set, version: int):
+    """
+    Remove cached model files that are not in keep and belong to a version
+    older than the given active version. Newer files may have just been
+    fetched by another worker, and files that are still being downloaded are
+    locked, so both are left alone. Workers that still use a removed file
+    keep their memory mapping until they switch models.
+    """
+    if not os.path.isdir(MODEL_CACHE_DIR):
+        return
+    for name in os.listdir(MODEL_CACHE_DIR):
+        if not name.endswith((".keras", ".tflite", ".npz")) or name in keep:
+            continue
+        match = re.match(r"flowers_(\d+)\.", name)
+        if match is None or int(match.group(1)) >= version:
+            continue
+        path = os.path.join(MODEL_CACHE_DIR, name)
+        with open(path + ".lock", "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            os.remove(path)
+        logging.info(f"Removed cached model file {name}.")
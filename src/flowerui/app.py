@@ -7,8 +7,8 @@ import io
 import json
 
 #from PIL import Image
-from azure.storage.queue import QueueServiceClient
-from azure.storage.blob import BlobServiceClient
+# Shared storage clients, imported once per process so they survive Streamlit reruns
+from storage import upload_bytes, send_message
 
 
 # Set the logging level for this script
@@ -18,37 +18,6 @@ logging.basicConfig(level=logging.INFO)
 azure_logger = logging.getLogger('azure')
 azure_logger.setLevel(logging.WARNING)
 
-# Decide if we're running in the cloud or locally
-CLOUD = os.environ.get("USE_AZURE_CREDENTIAL", "false").lower() == "true"
-
-def get_blob_service_client():
-    """
-    The STORAGE_CONNECTION_STRING is only set up when running in the cloud. 
-    If it's not set, we're running locally with Azurite.
-    """
-    if CLOUD:
-        from azure.identity import DefaultAzureCredential # type: ignore
-        credential = DefaultAzureCredential()
-        account_url = os.environ["STORAGE_BLOB_URL"]
-        return BlobServiceClient(account_url=account_url, credential=credential)
-    else:
-        return BlobServiceClient.from_connection_string(os.environ["STORAGE_CONNECTION_STRING"])
-
-def get_queue_service_client():
-    """
-    The STORAGE_CONNECTION_STRING is only set up when running in the cloud. 
-    If it's not set, we're running locally with Azurite.
-    """
-    if CLOUD:
-        from azure.identity import DefaultAzureCredential # type: ignore
-        credential = DefaultAzureCredential()
-        account_url = os.environ["STORAGE_QUEUE_URL"]
-        return QueueServiceClient(account_url=account_url, credential=credential)
-    else:
-        return QueueServiceClient.from_connection_string(os.environ["STORAGE_CONNECTION_STRING"])
-
-
-
 URL = os.environ["PREDICT_URL"]
 
 if not URL:
@@ -105,31 +74,19 @@ if image_file is not None:
 
         # Upload the image to Azure Blob storage
 
-        with get_blob_service_client() as blob_service_client:
-            # Generate unique filename
-            blob_name = f"{uuid.uuid4()}_{image_file.name}"
+        # Generate unique filename
+        blob_name = f"{uuid.uuid4()}_{image_file.name}"
 
-            # Get the container and blob clients
-            container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
-            blob_client = container_client.get_blob_client(blob_name)
-
-            # Upload file to Azure Blob Storage
-            with io.BytesIO(image_file.getvalue()) as uploaded_file:
-                blob_client.upload_blob(uploaded_file.read(), overwrite=True)
-
-                print(f"File: {blob_name} loaded to blob storage.")
+        # Upload file to Azure Blob Storage
+        upload_bytes(blob_name, image_file.getvalue())
+        print(f"File: {blob_name} loaded to blob storage.")
 
         # Send image name and label to the queue as a json structure
-        with get_queue_service_client() as queue_service_client:
-
-            with queue_service_client.get_queue_client(os.environ["STORAGE_QUEUE"]) as queue_client:
-
-                # Construct the queue message with blob URL and label
-                message = {
-                    "blob_name": blob_name,
-                    "label": label_index
-                }
-                queue_client.send_message(json.dumps(message))
-
-                logging.info(f"Message ({blob_name}) and ({label_index}) sent to Queue ({os.environ['STORAGE_QUEUE']})")
-                st.write(f"Sent: {blob_name} as {label_index}")
+        message = {
+            "blob_name": blob_name,
+            "label": label_index
+        }
+        send_message(json.dumps(message))
+
+        logging.info(f"Message ({blob_name}) and ({label_index}) sent to Queue ({os.environ['STORAGE_QUEUE']})")
+        st.write(f"Sent: {blob_name} as {label_index}")
@@ -0,0 +1,78 @@
+import os
+import logging
+
+import numpy as np
+
+from io import BytesIO
+
+from delta import apply_delta, save_delta
+from profiling import RunProfile
+from storage import blob_path, download_to_file, get_container_client
+from utils import load_model, publish_manifest, upload
+
+# Publish only the weights that changed since the last full model
+DELTA_ARTIFACTS = os.environ.get("DELTA_ARTIFACTS", "true").lower() == "true"
+# A full model is published instead when the delta is larger than this fraction of the weights
+DELTA_MAX_RATIO = float(os.environ.get("DELTA_MAX_RATIO", "0.5"))
+
+
+def weights_snapshot(model) -> list:
+    return [np.array(weight) for weight in model.get_weights()]
+
+
+def load_published(manifest: dict | None, version: int):
+    """
+    Load a published model version. Returns (model, base_version, base_weights),
+    where base is the full model that deltas of the next versions refer to.
+    """
+    delta = (manifest or {}).get("delta") if (manifest or {}).get("version") == version else None
+    if delta is None:
+        model = load_model(version)
+        return model, version, weights_snapshot(model)
+
+    base_version = int(delta["base_version"])
+    model = load_model(base_version)
+    base_weights = weights_snapshot(model)
+    if (path := blob_path(delta["blob_name"])) is not None:
+        apply_delta(model, path)
+    else:
+        with BytesIO() as data:
+            download_to_file(delta["blob_name"], data)
+            data.seek(0)
+            apply_delta(model, data)
+    logging.info(f"Rebuilt model version {version} from base {base_version} and {delta['blob_name']}.")
+    return model, base_version, base_weights
+
+
+def publish_model(model, version: int, base_version: int | None, base_weights: list | None, tflite: dict | None = None,
+                  profile: RunProfile | None = None):
+    """
+    Upload a new model version and point the manifest to it. If DELTA_ARTIFACTS
+    is on and the delta against the base is small enough, only the delta is
+    uploaded, otherwise the full .keras model, which becomes the new base.
+    Returns the (base_version, base_weights) for the next version.
+    """
+    profile = profile or RunProfile()
+    if DELTA_ARTIFACTS and base_weights is not None:
+        with profile.stage("save_delta"):
+            n_changed = save_delta(model, base_weights, "temp_model.delta.npz")
+        size = os.path.getsize("temp_model.delta.npz")
+        base_bytes = sum(weight.nbytes for weight in base_weights)
+        logging.info(f"Delta against version {base_version}: {n_changed} weight arrays, {size} bytes.")
+        if size <= DELTA_MAX_RATIO * base_bytes:
+            base_blob = f"models/flowers_{base_version}.keras"
+            base = get_container_client().get_blob_client(base_blob).get_blob_properties()
+            delta_blob = f"models/flowers_{version}.delta.npz"
+            with profile.stage("upload"):
+                result = upload("temp_model.delta.npz", delta_blob)
+            delta = {"blob_name": delta_blob, "base_version": base_version, "etag": result["etag"], "size": size}
+            publish_manifest(version, base_blob, base.etag, base.size, tflite, delta)
+            return base_version, base_weights
+
+    with profile.stage("save"):
+        model.save("temp_model.keras")
+    model_blob = f"models/flowers_{version}.keras"
+    with profile.stage("upload"):
+        result = upload("temp_model.keras", model_blob)
+    publish_manifest(version, model_blob, result["etag"], os.path.getsize("temp_model.keras"), tflite)
+    return version, weights_snapshot(model)
@@ -0,0 +1,130 @@
+import os
+import time
+import logging
+import threading
+
+from azure.core.exceptions import HttpResponseError, ResourceExistsError
+
+# Modellers elect the one that trains and publishes with a lease on this blob
+LEADER_LOCK_BLOB = os.environ.get("LEADER_LOCK_BLOB", "locks/modeller.lock")
+# Lease length in seconds (15-60), the leader renews it three times per period
+LEADER_LEASE_SECONDS = int(os.environ.get("LEADER_LEASE_SECONDS", "30"))
+# After losing an election, wait this long before trying again
+LEADER_RETRY_SECONDS = float(os.environ.get("LEADER_RETRY_SECONDS", "30"))
+
+
+class LeaderLease:
+    """
+    Leader election between modeller instances through a blob lease.
+
+    Every instance ingests feedback, but only the one holding the lease on
+    LEADER_LOCK_BLOB trains and publishes models. The leader renews the
+    lease in a background thread, so it keeps the role until it stops or
+    can no longer reach the storage. Then the lease expires after at most
+    LEADER_LEASE_SECONDS and another instance takes over.
+    """
+
+    def __init__(self, container_client, blob_name: str = LEADER_LOCK_BLOB, duration: int = LEADER_LEASE_SECONDS,
+                 retry_seconds: float = LEADER_RETRY_SECONDS):
+        self.blob_client = container_client.get_blob_client(blob_name)
+        self.duration = duration
+        self.retry_seconds = retry_seconds
+        self._next_attempt = 0.0
+        self._lease = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def is_leader(self) -> bool:
+        return self._lease is not None
+
+    def try_acquire(self) -> bool:
+        """
+        Become the leader if nobody else is. Returns True if this instance is
+        the leader. A failed attempt is not repeated for retry_seconds, so
+        followers do not make two storage calls on every poll.
+        """
+        with self._lock:
+            if self._lease is not None:
+                return True
+            if time.monotonic() < self._next_attempt:
+                return False
+            try:
+                self.blob_client.upload_blob(b"", overwrite=False)
+            except ResourceExistsError:
+                pass
+            try:
+                self._lease = self.blob_client.acquire_lease(lease_duration=self.duration)
+            except HttpResponseError as e:
+                if e.status_code == 409:
+                    self._next_attempt = time.monotonic() + self.retry_seconds
+                    return False
+                raise
+        logging.info(f"This modeller is now the leader ({self.blob_client.blob_name}).")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._renew, name="leader-lease", daemon=True)
+        self._thread.start()
+        return True
+
+    def _renew(self):
+        while not self._stop.wait(self.duration / 3):
+            try:
+                self._lease.renew()
+            except Exception:
+                logging.exception("Could not renew the leader lease, giving up the leader role.")
+                with self._lock:
+                    self._lease = None
+                return
+
+    def release(self):
+        self._stop.set()
+        with self._lock:
+            if self._lease is not None:
+                try:
+                    self._lease.release()
+                except Exception:
+                    logging.exception("Could not release the leader lease.")
+                self._lease = None
+
+
+class MessageKeeper:
+    """
+    Keeps claimed queue messages invisible while they are being processed.
+
+    Messages are received with a short visibility timeout, and a background
+    thread extends it with update_message every timeout / 3 seconds. If the
+    modeller dies the messages reappear quickly for another instance, but
+    a long download does not let them expire. The receipts list is updated
+    in place with the new pop receipts, so use it for acknowledge() only
+    after the context has exited.
+    """
+
+    def __init__(self, queue_client, receipts: list, visibility_timeout: int):
+        self.queue_client = queue_client
+        self.receipts = receipts
+        self.visibility_timeout = visibility_timeout
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self._renew, name="message-keeper", daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _renew(self):
+        while not self._stop.wait(self.visibility_timeout / 3):
+            for i, (message, blob_name) in enumerate(self.receipts):
+                if self._stop.is_set():
+                    return
+                try:
+                    updated = self.queue_client.update_message(message, visibility_timeout=self.visibility_timeout)
+                    message.pop_receipt = updated.pop_receipt
+                    message.next_visible_on = updated.next_visible_on
+                except Exception:
+                    logging.exception(f"Could not extend the visibility of message {message.id}.")
+            logging.debug(f"Extended the visibility of {len(self.receipts)} messages.")
@@ -0,0 +1,180 @@
+import os
+import json
+import hashlib
+import logging
+
+import numpy as np
+import tensorflow as tf
+import keras
+
+from utils import TRAIN_BATCH_SIZE, VAL_IMAGES, VAL_LABELS
+from shards import shard_images
+
+# Train only the classifier head on cached backbone embeddings
+FAST_RETRAIN = os.environ.get("FAST_RETRAIN", "false").lower() == "true"
+EMBEDDING_CACHE_DIR = os.environ.get("EMBEDDING_CACHE_DIR", "./embeddings")
+HEAD_EPOCHS = int(os.environ.get("HEAD_EPOCHS", "10"))
+
+
+def image_hash(image_bytes: bytes) -> str:
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def split_model(model):
+    """
+    Split the model into the backbone (everything up to the last layer) and
+    the classifier head (the last Dense layer). Both share their weights
+    with the original model, so training the head updates the model.
+    """
+    backbone = keras.Model(inputs=model.inputs, outputs=model.layers[-2].output)
+    head = model.layers[-1]
+    return backbone, head
+
+
+def backbone_version(backbone) -> str:
+    """Hash of the backbone weights, embeddings are only valid for these weights."""
+    digest = hashlib.sha256()
+    for weight in backbone.weights:
+        digest.update(np.ascontiguousarray(weight.numpy()).tobytes())
+    return digest.hexdigest()[:16]
+
+
+class EmbeddingStore:
+    """
+    Append-only store of backbone embeddings on local disk, one directory per
+    backbone version. The vectors are kept in a raw float32 file that is
+    memory-mapped for reading, and index.json maps the image hash to its row
+    and label.
+    """
+
+    def __init__(self, root: str, version: str, dim: int):
+        self.dim = dim
+        self.directory = os.path.join(root, version)
+        os.makedirs(self.directory, exist_ok=True)
+        self.data_path = os.path.join(self.directory, "embeddings.f32")
+        self.index_path = os.path.join(self.directory, "index.json")
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        # The index is written after the vectors, so the data file can only be too long
+        n_bytes = os.path.getsize(self.data_path) if os.path.exists(self.data_path) else 0
+        if n_bytes < self._row_offset(len(self.index)):
+            logging.warning(f"Embedding data in {self.directory} is shorter than its index, starting over.")
+            self.index = {}
+
+    def __contains__(self, digest: str) -> bool:
+        return digest in self.index
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _row_offset(self, row: int) -> int:
+        return row * self.dim * np.dtype(np.float32).itemsize
+
+    def add(self, digests: list, embeddings: np.ndarray, labels: list, kind: str):
+        """Append new embeddings. kind is "val" or "feedback"."""
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(digests), self.dim)
+        row = len(self.index)
+        with open(self.data_path, "ab") as f:
+            # Drop rows left behind by an add that crashed before writing the index
+            f.truncate(self._row_offset(row))
+            f.write(embeddings.tobytes())
+        for digest, label in zip(digests, labels):
+            self.index[digest] = {"row": row, "label": int(label), "kind": kind}
+            row += 1
+        # Write the index atomically so a crash never leaves a broken index
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(self.index, f)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def load(self, digests: list):
+        """Return (embeddings, labels) for the given hashes, read through mmap."""
+        vectors = np.memmap(self.data_path, dtype=np.float32, mode="r", shape=(len(self.index), self.dim))
+        entries = [self.index[digest] for digest in digests]
+        rows = np.array([entry["row"] for entry in entries], dtype=np.int64)
+        labels = np.array([entry["label"] for entry in entries], dtype=np.int32)
+        return np.asarray(vectors[rows]), labels
+
+    def digests(self, kind: str) -> list:
+        return [digest for digest, entry in self.index.items() if entry["kind"] == kind]
+
+
+def embed_missing(backbone, store: EmbeddingStore, items, kind: str) -> list:
+    """
+    Compute embeddings for the (uint8 image, label) items that are not in the
+    store yet, TRAIN_BATCH_SIZE images at a time. The hash is taken over the
+    pixels, like for the validation images. Returns the hashes of all items.
+    """
+    digests, batch = [], []
+
+    def flush():
+        images = tf.cast(np.stack([data for _, data, _ in batch]), tf.float32) / 255.0
+        store.add([digest for digest, _, _ in batch], backbone(images, training=False), [label for _, _, label in batch], kind)
+        batch.clear()
+
+    for data, label in items:
+        digest = image_hash(data.tobytes())
+        digests.append(digest)
+        if digest in store or any(digest == queued for queued, _, _ in batch):
+            continue
+        batch.append((digest, data, label))
+        if len(batch) == TRAIN_BATCH_SIZE:
+            flush()
+    if batch:
+        flush()
+    return digests
+
+
+def embed_val(backbone, store: EmbeddingStore):
+    """
+    Compute embeddings for the preprocessed validation images that are not
+    in the store yet. The hash is taken over the uint8 pixels.
+    Returns the hashes of all validation images.
+    """
+    images = np.load(VAL_IMAGES, mmap_mode="r")
+    labels = np.load(VAL_LABELS)
+    digests, missing = [], []
+    for i in range(len(labels)):
+        digest = image_hash(images[i].tobytes())
+        digests.append(digest)
+        if digest not in store:
+            missing.append((i, digest))
+
+    for start in range(0, len(missing), TRAIN_BATCH_SIZE):
+        batch = missing[start:start + TRAIN_BATCH_SIZE]
+        rows = [i for i, _ in batch]
+        pixels = tf.cast(np.asarray(images[rows]), tf.float32) / 255.0
+        store.add([digest for _, digest in batch], backbone(pixels, training=False), labels[rows], "val")
+    return digests
+
+
+def fast_retrain(model, shard_paths: list, epochs: int = HEAD_EPOCHS):
+    """
+    Retrain only the classifier head. The backbone embeddings of the
+    validation images and of every feedback image seen so far are cached
+    by image hash and backbone version, so a retrain only runs the backbone
+    over images in shard_paths it has not seen and then fits and evaluates
+    the small head.
+    Returns the validation [loss, accuracy] of the head.
+    """
+    backbone, head = split_model(model)
+    dim = int(backbone.output.shape[-1])
+    store = EmbeddingStore(EMBEDDING_CACHE_DIR, backbone_version(backbone), dim)
+    logging.info(f"Embedding store {store.directory} has {len(store)} embeddings.")
+
+    val_digests = embed_val(backbone, store)
+    embed_missing(backbone, store, shard_images(shard_paths).as_numpy_iterator(), "feedback")
+
+    # Train on all feedback seen with this backbone, evaluate on the validation set
+    train_x, train_y = store.load(store.digests("feedback"))
+    val_x, val_y = store.load(val_digests)
+
+    head_model = keras.Sequential([keras.Input(shape=(dim,)), head])
+    head_model.compile(
+        optimizer=keras.optimizers.Adam(),
+        loss=keras.losses.SparseCategoricalCrossentropy(from_logits=True),
+        metrics=["accuracy"],
+    )
+    head_model.fit(train_x, train_y, epochs=epochs, batch_size=TRAIN_BATCH_SIZE, shuffle=True, verbose=2)
+    return head_model.evaluate(val_x, val_y, batch_size=256, verbose=2)
@@ -1,16 +1,18 @@
 
 import time
+import asyncio
 import logging
-import os
-import tempfile
-import tensorflow as tf
-import keras
-import shutil
-
-from keras.preprocessing import image
-from tensorflow.keras import preprocessing
+
 from datetime import datetime
 from utils import *
+from storage import get_container_client, get_queue_client
+from trigger import RetrainTrigger
+from performance import configure, prepare_model
+from artifacts import load_published, publish_model
+from profiling import RunProfile
+from coordination import LeaderLease, MessageKeeper
+from shards import write_feedback_shards, pending_shards, mark_trained
+from pipeline import PIPELINE_MODE, Pipeline, retrain, upload_tflite
 
 
 BLOB_CONTAINER_NAME = "uploaded-files"
@@ -23,104 +25,113 @@ logging.basicConfig(level=logging.INFO)
 azure_logger = logging.getLogger("azure")
 azure_logger.setLevel(logging.WARNING)
 
-# Load the validation data and rename the folders to get the same order as in the model
-load_valdata()
+# Thread pools and determinism, before TensorFlow runs its first operation
+configure()
 
-flower_list =  ['dandelion', 'daisy', 'tulips', 'sunflowers', 'roses']
-for old_name, new_name in [
-    ('./val/dandelion', './val/0_dandelion'),
-    ('./val/daisy', './val/1_daisy'),
-    ('./val/tulips', './val/2_tulips'),
-    ('./val/sunflowers', './val/3_sunflowers'),
-    ('./val/roses', './val/4_roses'),
-]:
-    if os.path.exists(new_name):
-        logging.info(f"Directory {new_name} already exists. Skipping rename.")
-        continue
-    if os.path.exists(old_name):
-        shutil.move(old_name, new_name)
-        logging.info(f"Renamed {old_name} to {new_name}.")
+# Load the preprocessed validation data, downloading it only if it has changed
+load_valdata()
 
 # Running the main loop
 
+# Clients on the shared, pooled storage connections of the process
+queue_client = get_queue_client()
+container_client = get_container_client()
+trigger = RetrainTrigger(queue_client)
+
+# Only the leader trains and publishes, every modeller ingests feedback into shards
+lease = LeaderLease(container_client)
+
+
+def pending_images() -> int:
+    """Images ingested by any modeller but not trained on yet, only the leader trains them."""
+    shards = pending_shards(container_client)
+    if not shards or not lease.try_acquire():
+        return 0
+    return sum(shards.values())
+
+
+# In pipeline mode ingestion, training and upload overlap, this never returns
+if PIPELINE_MODE:
+    asyncio.run(Pipeline(trigger, lease, container_client).run())
+
+# The model stays in memory between retrains and training continues from it.
+# base is the last full .keras model, newer versions are published as deltas against it.
+model = None
+model_version = None
+base_version, base_weights = None, None
+
 while True:
-    n_images = n_images_waiting()
-    # If there are more than N images in the queue, let's train the model
-    if n_images > 4:
-
-        # Load .keras model
-        latest_version = latest_model_version()
-        logging.info(f"Latest version: {latest_version}")
-        model_bytes = load_model(latest_version)
-
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".keras") as temp_file:
-            temp_file.write(model_bytes)
-            temp_file_path = temp_file.name
-        
-        model = tf.keras.models.load_model(temp_file_path)
+    # Timing, memory and transfer statistics of this cycle
+    profile = RunProfile()
+
+    # Wait until enough images are waiting, or the oldest one has waited too long
+    with profile.stage("wait"):
+        n_images = trigger.wait(pending=pending_images)
+
+    # Claim messages from the queue, the images are downloaded once into new feedback shards.
+    # The messages stay hidden from other modellers until the shards have been written.
+    with profile.stage("drain_queue") as stage:
+        records, receipts = get_all_from_queue(queue_client)
+        stage["images"] = len(records)
+    logging.info(f"len(records): {len(records)}.")
+
+    # Feedback whose download failed transiently is not acknowledged and comes back later
+    failed = set()
+    if len(records) > 0:
+        with MessageKeeper(queue_client, receipts, INGEST_VISIBILITY_TIMEOUT), profile.stage("ingest", images=len(records)):
+            write_feedback_shards(container_client, records, failed=failed)
+
+    # The feedback is now stored in the shards, delete it from the queue & blob
+    with profile.stage("acknowledge"):
+        acknowledge(queue_client, container_client, receipts, skip=failed)
+
+    # Other modellers only ingest, the lease is only contested when there is something to train
+    fresh = pending_shards(container_client)
+    if not fresh:
+        continue
+    if not lease.try_acquire():
+        logging.info("Another modeller is the leader, not training.")
+        continue
+
+    # Only download the model if someone else has published a newer version
+    manifest = read_manifest()
+    latest_version = latest_model_version(manifest)
+    logging.info(f"Latest version: {latest_version}, in memory: {model_version}")
+    if model is None or latest_version != model_version:
+        with profile.stage("load_model"):
+            model, base_version, base_weights = load_published(manifest, latest_version)
+            model = prepare_model(model)
+        model_version = latest_version
         logging.info(f"Model: {model.summary(show_trainable=True)}")
-        
-        # Use current UNIX time as the version of the model
-        model_version = int(time.time())
-        iso_time = datetime.fromtimestamp(model_version).isoformat()
-        logging.info(f"Found {n_images} images in Queue at {model_version} ({iso_time}).")
-
-        # Read all messages from queue and load corresponding images from blob
-        # Then delete messages from queue & images from blob
-        data_pairs = get_all_from_queue()
-
-        # Get all the images from the queue, deleting them from the queue
-        # Note that this is a risk; if the following process fails, the images are lost
-        new_images = get_all_from_queue()
-
-        # Separate images and labels
-        images = [pair[0] for pair in data_pairs] # List of image arrays
-        labels = [pair[1] for pair in data_pairs] # List of labels
-
-        logging.info(f"len(data_pairs): {len(data_pairs)}.")
-
-        # If queue reading was succesfull, we can train the model
-        if len(data_pairs) > 0:
-            
-            # Convert to tf.data.Datasets
-            train_ds = tf.data.Dataset.from_tensor_slices((images, labels))
-            train_ds = train_ds.batch(len(data_pairs)).shuffle(len(data_pairs))
-
-            # Create validation dataset from loaded validation data
-            val_ds = keras.utils.image_dataset_from_directory(
-                './val/',
-                validation_split=None,
-                seed=123,
-                image_size=(IMAGE_RES, IMAGE_RES),
-                batch_size=32                
-                    )
-
-            # Image preprocessing
-            def format_train_image(image, label):
-                image = tf.image.resize(image, (IMAGE_RES, IMAGE_RES))/255.0 # Normalization is needed
-                return image, label
-            
-            def format_val_image(image, label):
-                image = tf.image.resize(image, (IMAGE_RES, IMAGE_RES))/255.0
-                return image, label
-            
-            train_batches = train_ds.map(format_train_image).prefetch(tf.data.AUTOTUNE)
-            val_batches = val_ds.map(format_val_image).prefetch(tf.data.AUTOTUNE)
-
-            # Train the model
-            history = model.fit(train_batches,
-                        epochs=3,
-                        batch_size=len(data_pairs),
-                        )
-
-            # Evaluate the model
-            model.evaluate(val_batches, verbose=2)
-
-            # Upload the model to Azure Storage
-            model.save("temp_model.keras")
-            upload("temp_model.keras", f"models/flowers_{model_version}.keras")
-    
-    else: 
-        logging.info("No images to process")
-
-    time.sleep(10)
+
+    # Use current UNIX time as the version of the new model, always newer than the published one
+    new_version = max(int(time.time()), latest_version + 1)
+    profile.version = new_version
+    iso_time = datetime.fromtimestamp(new_version).isoformat()
+    logging.info(f"Training version {new_version} ({iso_time}).")
+
+    # Train, evaluate and export the TFLite model
+    serving_model, accuracies = retrain(model, container_client, fresh, profile, "temp_model.tflite")
+    tflite = upload_tflite("temp_model.tflite", new_version, accuracies, profile)
+
+    # Another modeller may have taken over while this one was training
+    if not lease.is_leader:
+        logging.warning(f"Lost the leader role, not publishing version {new_version}.")
+        model = None
+        continue
+
+    # Upload the model, or only its changed weights, and point the manifest to it
+    try:
+        base_version, base_weights = publish_model(serving_model, new_version, base_version, base_weights, tflite, profile)
+    except StaleModelError as e:
+        logging.warning(f"{e} Reloading the published model.")
+        model = None
+        continue
+    # The model in memory is now the published one, no need to download it again
+    model_version = new_version
+    mark_trained(container_client, fresh, new_version)
+
+    try:
+        profile.publish()
+    except Exception:
+        logging.exception("Could not write the run manifest.")
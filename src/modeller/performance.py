@@ -0,0 +1,192 @@
+"""
+Training performance profile for the modeller.
+
+The settings are read from the environment, call configure() before
+TensorFlow runs its first operation and prepare_model() on every loaded
+model. Run this file directly to measure fit/evaluate throughput on the
+validation data with the current settings:
+
+    python performance.py --steps 20 --batch-sizes 16 32 64
+"""
+
+import os
+import json
+import time
+import logging
+import argparse
+
+import numpy as np
+import tensorflow as tf
+import keras
+
+# Thread pools, 0 lets TensorFlow decide. On a dedicated node intra-op ~= number of cores.
+TF_INTRA_OP_THREADS = int(os.environ.get("TF_INTRA_OP_THREADS", "0"))
+TF_INTER_OP_THREADS = int(os.environ.get("TF_INTER_OP_THREADS", "0"))
+# Compile the training step with XLA
+TRAIN_JIT_COMPILE = os.environ.get("TRAIN_JIT_COMPILE", "false").lower() == "true"
+# "float32", "bfloat16" or "auto" (bfloat16 only if the CPU has native bfloat16 instructions)
+TRAIN_PRECISION = os.environ.get("TRAIN_PRECISION", "float32").lower()
+# Reproducible training, slower because some ops lose their fast paths
+TRAIN_DETERMINISTIC = os.environ.get("TRAIN_DETERMINISTIC", "false").lower() == "true"
+TRAIN_SEED = int(os.environ.get("TRAIN_SEED", "1234"))
+
+
+def cpu_supports_bfloat16() -> bool:
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = f.read()
+    except OSError:
+        return False
+    return "avx512_bf16" in flags or "amx_bf16" in flags
+
+
+def training_policy(precision: str = TRAIN_PRECISION) -> str:
+    """Keras dtype policy to train with."""
+    if precision == "float32":
+        return "float32"
+    if cpu_supports_bfloat16():
+        return "mixed_bfloat16"
+    if precision == "bfloat16":
+        logging.warning("The CPU has no native bfloat16 support, training in float32.")
+    return "float32"
+
+
+def configure(intra_op_threads: int = TF_INTRA_OP_THREADS, inter_op_threads: int = TF_INTER_OP_THREADS,
+              deterministic: bool = TRAIN_DETERMINISTIC, seed: int = TRAIN_SEED):
+    """Apply the process-wide settings, this has to happen before TensorFlow runs its first operation."""
+    if intra_op_threads:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+    if inter_op_threads:
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    if deterministic:
+        keras.utils.set_random_seed(seed)
+        tf.config.experimental.enable_op_determinism()
+    logging.info(
+        f"Training profile: intra-op {intra_op_threads or 'auto'}, inter-op {inter_op_threads or 'auto'}, "
+        f"jit_compile {TRAIN_JIT_COMPILE}, precision {TRAIN_PRECISION}, deterministic {deterministic}"
+    )
+
+
+def with_policy(model, policy: str):
+    """
+    Rebuild the model with another dtype policy and copy the weights over.
+    A loaded model keeps the policy it was saved with, so the global policy
+    does not apply to it. The last layer stays float32 for a stable softmax.
+    """
+    last = model.layers[-1]
+
+    def clone(layer):
+        config = layer.get_config()
+        if layer is not last and "dtype" in config:
+            config["dtype"] = policy
+        return layer.__class__.from_config(config)
+
+    rebuilt = keras.models.clone_model(model, clone_function=clone)
+    rebuilt.set_weights(model.get_weights())
+    return rebuilt
+
+
+def prepare_model(model, jit_compile: bool = TRAIN_JIT_COMPILE, precision: str = TRAIN_PRECISION):
+    """Return the model set up for training with the profile's precision and XLA setting."""
+    policy = training_policy(precision)
+    if policy == "float32" and not jit_compile:
+        return model
+    optimizer = model.optimizer
+    if policy != "float32":
+        model = with_policy(model, policy)
+        optimizer = optimizer.__class__.from_config(optimizer.get_config())
+    model.compile(optimizer=optimizer, loss=model.loss, metrics=["accuracy"], jit_compile=jit_compile)
+    return model
+
+
+def for_serving(model):
+    """The model as float32 for saving, so flowerpredict never runs bfloat16 on CPUs without support."""
+    if all(layer.dtype_policy.name == "float32" for layer in model.layers):
+        return model
+    serving = with_policy(model, "float32")
+    serving.compile(optimizer=model.optimizer.__class__.from_config(model.optimizer.get_config()),
+                    loss=model.loss, metrics=["accuracy"])
+    return serving
+
+
+def benchmark(model, images: np.ndarray, labels: np.ndarray, batch_size: int, steps: int) -> dict:
+    """Images/sec of fit and evaluate, after one untimed warm-up step of each."""
+    n = batch_size * steps
+    rows = np.arange(n) % len(labels)
+    x = tf.cast(images[rows], tf.float32) / 255.0
+    y = labels[rows]
+
+    model.fit(x[:batch_size], y[:batch_size], batch_size=batch_size, epochs=1, verbose=0)
+    start = time.perf_counter()
+    model.fit(x, y, batch_size=batch_size, epochs=1, shuffle=False, verbose=0)
+    fit_s = time.perf_counter() - start
+
+    model.evaluate(x[:batch_size], y[:batch_size], batch_size=batch_size, verbose=0)
+    start = time.perf_counter()
+    model.evaluate(x, y, batch_size=batch_size, verbose=0)
+    evaluate_s = time.perf_counter() - start
+
+    return {
+        "batch_size": batch_size,
+        "images": n,
+        "fit_images_per_s": n / fit_s,
+        "evaluate_images_per_s": n / evaluate_s,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure modeller training throughput on the validation data")
+    parser.add_argument("--model-version", type=int, help="Model version to load, defaults to the latest")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[32])
+    parser.add_argument("--steps", type=int, default=20, help="Timed batches per measurement")
+    parser.add_argument("--no-download", action="store_true", help="Use the validation cache as it is")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("azure").setLevel(logging.WARNING)
+    configure()
+
+    # Imported here so the thread settings are applied first
+    from utils import VAL_IMAGES, VAL_LABELS, load_valdata, read_manifest, latest_model_version
+    from artifacts import load_published
+
+    if not args.no_download:
+        load_valdata()
+    images = np.load(VAL_IMAGES, mmap_mode="r")
+    labels = np.load(VAL_LABELS)
+    manifest = read_manifest()
+    version = args.model_version or latest_model_version(manifest)
+
+    results = []
+    for batch_size in args.batch_sizes:
+        # A fresh copy of the model every time, fit changes the weights
+        model = prepare_model(load_published(manifest, version)[0])
+        result = benchmark(model, images, labels, batch_size, args.steps)
+        logging.info(
+            f"batch {batch_size}: fit {result['fit_images_per_s']:.1f} images/s, "
+            f"evaluate {result['evaluate_images_per_s']:.1f} images/s"
+        )
+        results.append(result)
+
+    report = {
+        "model_version": version,
+        "cpus": os.cpu_count(),
+        "profile": {
+            "intra_op_threads": TF_INTRA_OP_THREADS,
+            "inter_op_threads": TF_INTER_OP_THREADS,
+            "jit_compile": TRAIN_JIT_COMPILE,
+            "precision": TRAIN_PRECISION,
+            "policy": training_policy(),
+            "deterministic": TRAIN_DETERMINISTIC,
+        },
+        "results": results,
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
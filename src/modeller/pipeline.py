@@ -0,0 +1,369 @@
+import os
+import time
+import queue
+import asyncio
+import logging
+
+from collections import deque
+
+import numpy as np
+import keras
+
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+
+from utils import (
+    INGEST_WORKERS, INGEST_MAX_MESSAGES, INGEST_VISIBILITY_TIMEOUT, VAL_LABELS,
+    StaleModelError, latest_model_version, read_manifest, read_message, upload, val_dataset,
+)
+from export import EXPORT_TFLITE, export_checked_tflite
+from embeddings import FAST_RETRAIN, fast_retrain
+from performance import prepare_model, for_serving
+from artifacts import load_published, publish_model
+from profiling import RunProfile
+from shards import write_feedback_shards, pending_shards, history_shards, mark_trained, fetch_shards, feedback_dataset
+from trigger import POLL_MIN_SECONDS, POLL_MAX_SECONDS
+from storage import aio_clients, count_transfer
+
+# Run ingestion, training and upload as overlapping asyncio stages
+PIPELINE_MODE = os.environ.get("MODELLER_PIPELINE", "false").lower() == "true"
+TRAIN_EPOCHS = int(os.environ.get("TRAIN_EPOCHS", "3"))
+
+
+def retrain(model, container_client, fresh: dict, profile: RunProfile, tflite_path: str):
+    """
+    Train the model on the fresh shards mixed with a sample of older shards,
+    evaluate it and export the TFLite model to tflite_path.
+    Returns (float32 serving model, TFLite accuracies or None).
+    """
+    # Validation batches from the preprocessed, memory-mapped cache
+    val_batches = val_dataset()
+
+    # Train on the new feedback from all modellers mixed with a sample of older shards
+    with profile.stage("fetch_shards"):
+        shards = {**fresh, **history_shards(container_client)}
+        shard_paths = fetch_shards(container_client, list(shards))
+    n_train = sum(shards.values())
+    logging.info(f"Training on {len(fresh)} new and {len(shards) - len(fresh)} earlier shards, {n_train} images.")
+
+    if FAST_RETRAIN:
+        # Only the classifier head is trained, on cached backbone embeddings
+        with profile.stage("fast_retrain", images=n_train):
+            fast_retrain(model, shard_paths)
+    else:
+        with profile.stage("fit", images=n_train * TRAIN_EPOCHS), profile.trace():
+            model.fit(feedback_dataset(shard_paths), epochs=TRAIN_EPOCHS)
+
+        with profile.stage("evaluate", images=len(np.load(VAL_LABELS))):
+            model.evaluate(val_batches, verbose=2)
+
+    # The model is published as float32
+    serving_model = for_serving(model)
+
+    # Export the quantized serving model, if it is accurate enough
+    accuracies = None
+    if EXPORT_TFLITE:
+        try:
+            with profile.stage("export_tflite"):
+                accuracies = export_checked_tflite(serving_model, tflite_path, val_batches)
+        except Exception:
+            logging.exception("TFLite export failed, publishing only the .keras model.")
+    return serving_model, accuracies
+
+
+def upload_tflite(tflite_path: str, version: int, accuracies: dict | None, profile: RunProfile) -> dict | None:
+    """Upload an exported TFLite model and return its manifest entry."""
+    if accuracies is None:
+        return None
+    tflite_blob = f"models/flowers_{version}.tflite"
+    with profile.stage("upload_tflite"):
+        result = upload(tflite_path, tflite_blob)
+    return {
+        "blob_name": tflite_blob,
+        "etag": result["etag"],
+        "size": os.path.getsize(tflite_path),
+        **accuracies,
+    }
+
+
+def copy_model(model):
+    """
+    A compiled copy of the model with its own weights. clone_model() returns
+    an uncompiled model, and a .keras file saved from it could not be trained
+    on after the next reload.
+    """
+    snapshot = keras.models.clone_model(model)
+    snapshot.set_weights(model.get_weights())
+    snapshot.compile(optimizer=model.optimizer.__class__.from_config(model.optimizer.get_config()),
+                     loss=model.loss, metrics=["accuracy"])
+    return snapshot
+
+
+async def claim_messages(queue_client, max_messages: int = INGEST_MAX_MESSAGES):
+    """Async get_all_from_queue(): returns the (blob_name, label) records and the receipts."""
+    records, receipts = [], []
+    messages = queue_client.receive_messages(
+        messages_per_page=32,
+        visibility_timeout=INGEST_VISIBILITY_TIMEOUT,
+        max_messages=max_messages or None,
+    )
+    async for msg in messages:
+        record = read_message(msg)
+        receipts.append((msg, record[0] if record else None))
+        if record is not None:
+            records.append(record)
+    logging.info(f"Got {len(records)} images from the queue.")
+    return records, receipts
+
+
+async def keep_visible(queue_client, receipts: list, visibility_timeout: int = INGEST_VISIBILITY_TIMEOUT):
+    """Async MessageKeeper: extend the visibility of the claimed messages until cancelled."""
+    while True:
+        await asyncio.sleep(visibility_timeout / 3)
+        for message, _ in receipts:
+            try:
+                updated = await queue_client.update_message(message, visibility_timeout=visibility_timeout)
+                message.pop_receipt = updated.pop_receipt
+                message.next_visible_on = updated.next_visible_on
+            except Exception:
+                logging.exception(f"Could not extend the visibility of message {message.id}.")
+
+
+async def download_images(container_client, records: list, failed: set):
+    """
+    Yield (jpeg bytes, label) in order, with INGEST_WORKERS downloads running
+    at the same time. Transient download failures are added to failed.
+    """
+    async def download(blob_name):
+        try:
+            downloader = await container_client.get_blob_client(blob_name).download_blob()
+            data = await downloader.readall()
+            count_transfer("downloaded", len(data))
+            return data
+        except ResourceNotFoundError:
+            logging.warning(f"{blob_name} does not exist, dropping its feedback.")
+            return None
+        except Exception:
+            logging.exception(f"Could not download {blob_name}, leaving it in the queue.")
+            failed.add(blob_name)
+            return None
+
+    pending = deque()
+    for blob_name, label in records:
+        pending.append((asyncio.ensure_future(download(blob_name)), label))
+        if len(pending) >= INGEST_WORKERS:
+            future, label = pending.popleft()
+            if (data := await future) is not None:
+                yield data, label
+    while pending:
+        future, label = pending.popleft()
+        if (data := await future) is not None:
+            yield data, label
+
+
+async def ingest(container_client, aio_container_client, records: list, failed: set) -> dict:
+    """
+    Download the images with the async client and write them into shards.
+    Decoding and writing run in a thread, fed through a bounded queue.
+    """
+    images = queue.Queue(maxsize=INGEST_WORKERS * 2)
+
+    def consume():
+        return write_feedback_shards(container_client, records, iter(images.get, None))
+
+    writer = asyncio.ensure_future(asyncio.to_thread(consume))
+
+    async def put(item):
+        while True:
+            try:
+                images.put_nowait(item)
+                return
+            except queue.Full:
+                if writer.done():
+                    # The writer failed, raise its exception
+                    writer.result()
+                await asyncio.sleep(0.01)
+
+    async for item in download_images(aio_container_client, records, failed):
+        await put(item)
+    await put(None)
+    return await writer
+
+
+async def acknowledge_async(queue_client, container_client, receipts: list, skip: set = frozenset()):
+    """Async acknowledge(): delete the blobs in batches of 256 and the messages concurrently."""
+    if skip:
+        logging.info(f"Leaving {len(skip)} messages with failed downloads in the queue.")
+        receipts = [receipt for receipt in receipts if receipt[1] not in skip]
+    blob_names = [blob_name for _, blob_name in receipts if blob_name]
+    for start in range(0, len(blob_names), 256):
+        chunk = blob_names[start:start + 256]
+        try:
+            await container_client.delete_blobs(*chunk)
+        except Exception:
+            logging.warning("Batch delete failed, deleting blobs one by one.")
+            for blob_name in chunk:
+                try:
+                    await container_client.delete_blob(blob_name)
+                except ResourceNotFoundError:
+                    pass
+
+    semaphore = asyncio.Semaphore(INGEST_WORKERS)
+
+    async def delete(message):
+        async with semaphore:
+            try:
+                await queue_client.delete_message(message)
+            except ResourceNotFoundError:
+                logging.warning(f"Message {message.id} was already deleted or its pop receipt is stale.")
+            except HttpResponseError:
+                logging.exception(f"Could not delete message {message.id}, it will be delivered again.")
+
+    await asyncio.gather(*(delete(message) for message, _ in receipts))
+    logging.info(f"Acknowledged {len(receipts)} messages.")
+
+
+class Pipeline:
+    """
+    Double-buffered modeller loop.
+
+    Three asyncio tasks run at the same time: ingestion claims messages and
+    writes the next feedback shards while the current model trains, training
+    runs model.fit in a worker thread, and the upload task publishes the
+    previous model in the background. A finished model waits in a queue of
+    size one, so at most one model is uploading while the next one trains,
+    and throughput is limited by the slowest stage instead of their sum.
+    """
+
+    def __init__(self, trigger, lease, container_client):
+        self.trigger = trigger
+        self.lease = lease
+        self.container_client = container_client
+        self.new_shards = asyncio.Event()
+        self.uploads = asyncio.Queue(maxsize=1)
+        # Shards trained into a model that has not been published yet
+        self.in_flight = set()
+        # Last full model that deltas refer to, only changed by the upload task after the first load
+        self.base = (None, None)
+        # Model being trained and its version, loaded from the published one when reload is set
+        self.model, self.version = None, None
+        # Set when the model in memory no longer matches the published one
+        self.reload = True
+
+    async def run(self):
+        async with aio_clients() as (aio_blob_service_client, aio_queue_service_client):
+            aio_container_client = aio_blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
+            aio_queue_client = aio_queue_service_client.get_queue_client(os.environ["STORAGE_QUEUE"])
+            await asyncio.gather(
+                self.ingest_loop(aio_queue_client, aio_container_client),
+                self.train_loop(),
+                self.upload_loop(),
+            )
+
+    async def ingest_loop(self, queue_client, container_client):
+        while True:
+            # A failed round is logged and retried, the unacknowledged messages come back
+            try:
+                await self.ingest_once(queue_client, container_client)
+            except Exception:
+                logging.exception("Ingesting feedback failed, retrying.")
+                await asyncio.sleep(POLL_MIN_SECONDS)
+
+    async def ingest_once(self, queue_client, container_client):
+        await asyncio.to_thread(self.trigger.wait)
+        records, receipts = await claim_messages(queue_client)
+        failed = set()
+        if records:
+            keeper = asyncio.ensure_future(keep_visible(queue_client, receipts))
+            try:
+                await ingest(self.container_client, container_client, records, failed)
+            finally:
+                keeper.cancel()
+        await acknowledge_async(queue_client, container_client, receipts, skip=failed)
+        if records:
+            self.new_shards.set()
+
+    async def train_loop(self):
+        while True:
+            # Wake up on own shards, and now and then for shards written by other modellers
+            try:
+                await asyncio.wait_for(self.new_shards.wait(), timeout=POLL_MAX_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            self.new_shards.clear()
+
+            try:
+                await self.train_once()
+            except Exception:
+                # Start again from the published model, the shards stay untrained
+                logging.exception("Training failed, reloading the published model.")
+                self.reload = True
+                await asyncio.sleep(POLL_MIN_SECONDS)
+
+    async def train_once(self):
+        shards = await asyncio.to_thread(pending_shards, self.container_client)
+        fresh = {name: n for name, n in shards.items() if name not in self.in_flight}
+        if not fresh:
+            return
+        was_leader = self.lease.is_leader
+        if not await asyncio.to_thread(self.lease.try_acquire):
+            self.reload = True
+            return
+        # A new leader starts from the published model
+        if not was_leader:
+            self.reload = True
+
+        profile = RunProfile()
+        if self.reload:
+            # Wait for the upload in progress, then start from the published model
+            await self.uploads.join()
+            manifest = await asyncio.to_thread(read_manifest)
+            version = await asyncio.to_thread(latest_model_version, manifest)
+            with profile.stage("load_model"):
+                model, base_version, base_weights = await asyncio.to_thread(load_published, manifest, version)
+                self.model = await asyncio.to_thread(prepare_model, model)
+            self.version = version
+            self.base = (base_version, base_weights)
+            self.reload = False
+
+        version = max(int(time.time()), self.version + 1)
+        profile.version = version
+        tflite_path = f"temp_model_{version}.tflite"
+        self.in_flight.update(fresh)
+        try:
+            serving_model, accuracies = await asyncio.to_thread(
+                retrain, self.model, self.container_client, fresh, profile, tflite_path
+            )
+            # Training continues on model, so the upload gets its own copy of the weights
+            snapshot = await asyncio.to_thread(copy_model, serving_model)
+        except BaseException:
+            self.in_flight.difference_update(fresh)
+            if os.path.exists(tflite_path):
+                os.remove(tflite_path)
+            raise
+        self.version = version
+        await self.uploads.put((snapshot, version, fresh, accuracies, tflite_path, profile))
+
+    async def upload_loop(self):
+        # Every failure is handled per model below, so this loop never stops
+        while True:
+            model, version, fresh, accuracies, tflite_path, profile = await self.uploads.get()
+            try:
+                if not self.lease.is_leader:
+                    logging.warning(f"Lost the leader role, not publishing version {version}.")
+                    self.reload = True
+                    continue
+                tflite = await asyncio.to_thread(upload_tflite, tflite_path, version, accuracies, profile)
+                self.base = await asyncio.to_thread(publish_model, model, version, *self.base, tflite, profile)
+                await asyncio.to_thread(mark_trained, self.container_client, fresh, version)
+                await asyncio.to_thread(profile.publish)
+            except StaleModelError as e:
+                logging.warning(f"{e} Reloading the published model.")
+                self.reload = True
+            except Exception:
+                logging.exception(f"Publishing version {version} failed, its shards will be trained again.")
+                self.reload = True
+            finally:
+                self.in_flight.difference_update(fresh)
+                if os.path.exists(tflite_path):
+                    os.remove(tflite_path)
+                self.uploads.task_done()
@@ -0,0 +1,97 @@
+import os
+import json
+import time
+import logging
+import resource
+
+from contextlib import contextmanager
+from datetime import datetime
+
+import tensorflow as tf
+
+from storage import TRANSFER_COUNTERS, upload_bytes
+
+# Capture a TensorFlow profiler trace of model.fit into PROFILE_DIR/<version>
+RUN_PROFILE_TRACE = os.environ.get("RUN_PROFILE_TRACE", "false").lower() == "true"
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "./profiles")
+
+
+def current_rss() -> int:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def peak_rss() -> int:
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class RunProfile:
+    """
+    Timing and resource usage of one retrain cycle, stage by stage.
+    Every stage records its wall time, the resident memory at its end, the
+    peak resident memory of the process so far, the bytes downloaded and
+    uploaded by the stage itself, and images/sec when the number of images
+    is known. The bytes are counted per thread or asyncio task, so stages
+    that overlap in pipeline mode do not count each other's transfers.
+    """
+
+    def __init__(self):
+        self.version = None
+        self.started_at = datetime.now().isoformat()
+        self.stages = []
+        self.info = {}
+
+    @contextmanager
+    def stage(self, name: str, images: int | None = None):
+        """Time a stage. The yielded dict can be used to add fields, e.g. images."""
+        entry = {"name": name}
+        if images is not None:
+            entry["images"] = images
+        transferred = {"downloaded": 0, "uploaded": 0}
+        token = TRANSFER_COUNTERS.set(TRANSFER_COUNTERS.get() + (transferred,))
+        start = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            TRANSFER_COUNTERS.reset(token)
+            entry["seconds"] = time.perf_counter() - start
+            entry["downloaded_bytes"] = transferred["downloaded"]
+            entry["uploaded_bytes"] = transferred["uploaded"]
+            entry["rss_bytes"] = current_rss()
+            entry["peak_rss_bytes"] = peak_rss()
+            if entry.get("images") and entry["seconds"] > 0:
+                entry["images_per_s"] = entry["images"] / entry["seconds"]
+            self.stages.append(entry)
+            logging.info(f"Stage {name} took {entry['seconds']:.2f} s.")
+
+    @contextmanager
+    def trace(self):
+        """Capture a TensorFlow profiler trace if RUN_PROFILE_TRACE is on."""
+        if not RUN_PROFILE_TRACE:
+            yield
+            return
+        log_dir = os.path.join(PROFILE_DIR, str(self.version))
+        tf.profiler.experimental.start(log_dir)
+        try:
+            yield
+        finally:
+            tf.profiler.experimental.stop()
+            self.info["trace_dir"] = log_dir
+            logging.info(f"Profiler trace written to {log_dir}.")
+
+    def to_dict(self) -> dict:
+        return {
+            "version": self.version,
+            "started_at": self.started_at,
+            "seconds": sum(stage["seconds"] for stage in self.stages),
+            "peak_rss_bytes": peak_rss(),
+            "stages": self.stages,
+            **self.info,
+        }
+
+    def publish(self):
+        """Upload the run manifest next to the model as models/flowers_{version}.run.json."""
+        blob_name = f"models/flowers_{self.version}.run.json"
+        upload_bytes(blob_name, json.dumps(self.to_dict(), indent=2).encode(), content_type="application/json")
+        logging.info(f"Wrote run manifest {blob_name}.")
@@ -0,0 +1,208 @@
+import os
+import time
+import uuid
+import random
+import logging
+
+import numpy as np
+import tensorflow as tf
+
+from concurrent.futures import ThreadPoolExecutor
+from azure.core.exceptions import ResourceNotFoundError
+
+from storage import TRANSFER_CONCURRENCY, blob_path, count_transfer, with_transfer_counters
+from utils import (
+    IMAGE_RES, INGEST_WORKERS, TRAIN_BATCH_SIZE, SHUFFLE_BUFFER, PREFETCH_BATCHES,
+    decode_train_image, iter_feedback_images,
+)
+
+# Feedback is kept in the container as GZIP-compressed TFRecord shards
+FEEDBACK_SHARD_PREFIX = "datasets/feedback/"
+# An empty marker blob per untrained shard, so finding them does not list the whole history
+PENDING_SHARD_PREFIX = "datasets/feedback-pending/"
+# Maximum number of images in one shard
+SHARD_MAX_IMAGES = int(os.environ.get("SHARD_MAX_IMAGES", "1024"))
+# Number of earlier shards sampled into every retrain, 0 trains only on fresh feedback
+FEEDBACK_HISTORY_SHARDS = int(os.environ.get("FEEDBACK_HISTORY_SHARDS", "8"))
+# Local copy of the shards, they never change once written
+SHARD_CACHE_DIR = os.environ.get("SHARD_CACHE_DIR", "./shard_cache")
+
+FEATURES = {
+    "image": tf.io.FixedLenFeature([], tf.string),
+    "label": tf.io.FixedLenFeature([], tf.int64),
+}
+
+
+def local_path(blob_name: str) -> str:
+    return os.path.join(SHARD_CACHE_DIR, os.path.basename(blob_name))
+
+
+def to_uint8(image_bytes, label):
+    """Decode and resize a feedback image to the stored uint8 (224, 224, 3) form."""
+    image, label = decode_train_image(image_bytes, label)
+    return tf.cast(tf.clip_by_value(tf.round(image * 255.0), 0, 255), tf.uint8), label
+
+
+def serialize(image: np.ndarray, label: int) -> bytes:
+    example = tf.train.Example(features=tf.train.Features(feature={
+        "image": tf.train.Feature(bytes_list=tf.train.BytesList(value=[image.tobytes()])),
+        "label": tf.train.Feature(int64_list=tf.train.Int64List(value=[int(label)])),
+    }))
+    return example.SerializeToString()
+
+
+def write_feedback_shards(container_client, records: list, images=None, failed: set | None = None) -> dict:
+    """
+    Download and preprocess the feedback images once and append them to the
+    dataset as new shards. The shards are untrained until the leader has
+    published a model trained on them, see mark_trained(). images can be an
+    iterator of already downloaded (jpeg bytes, label) for the records.
+    Blobs that could not be downloaded because of a transient error are
+    added to failed, see iter_feedback_images().
+    Returns {blob name: number of images} of the new shards.
+    """
+    os.makedirs(SHARD_CACHE_DIR, exist_ok=True)
+    # Unique between modeller instances writing at the same time
+    batch_id = f"{int(time.time())}-{uuid.uuid4().hex[:8]}"
+    if images is None:
+        images = iter_feedback_images(container_client, records, failed)
+    source = images
+    images = tf.data.Dataset.from_generator(
+        lambda: source,
+        output_signature=(
+            tf.TensorSpec(shape=(), dtype=tf.string),
+            tf.TensorSpec(shape=(), dtype=tf.int32),
+        ),
+    )
+    images = images.map(to_uint8, num_parallel_calls=tf.data.AUTOTUNE, deterministic=False)
+    # Skip images that cannot be decoded instead of failing the whole retrain
+    images = images.ignore_errors(log_warning=True)
+
+    shards = {}
+    writer, path, count = None, None, 0
+
+    def close_shard():
+        writer.close()
+        blob_name = f"{FEEDBACK_SHARD_PREFIX}shard-{batch_id}-{len(shards):05d}.tfrecord.gz"
+        final_path = local_path(blob_name)
+        os.replace(path, final_path)
+        with open(final_path, "rb") as data:
+            container_client.upload_blob(blob_name, data, overwrite=True, metadata={"images": str(count)},
+                                         max_concurrency=TRANSFER_CONCURRENCY)
+        count_transfer("uploaded", os.path.getsize(final_path))
+        # Written after the shard, so a marker always points to a complete shard
+        container_client.upload_blob(pending_marker(blob_name), b"", overwrite=True, metadata={"images": str(count)})
+        logging.info(f"Wrote {count} images to {blob_name}.")
+        shards[blob_name] = count
+
+    for image, label in images.as_numpy_iterator():
+        if writer is None:
+            path = os.path.join(SHARD_CACHE_DIR, f"shard-{batch_id}.tmp")
+            writer = tf.io.TFRecordWriter(path, options="GZIP")
+            count = 0
+        writer.write(serialize(image, label))
+        count += 1
+        if count >= SHARD_MAX_IMAGES:
+            close_shard()
+            writer = None
+    if writer is not None:
+        close_shard()
+    return shards
+
+
+def pending_marker(blob_name: str) -> str:
+    return PENDING_SHARD_PREFIX + blob_name[len(FEEDBACK_SHARD_PREFIX):]
+
+
+def pending_shards(container_client) -> dict:
+    """
+    Shards written by any modeller that no published model has been trained
+    on yet, as {blob name: number of images}. Only their markers are listed.
+    """
+    return {
+        FEEDBACK_SHARD_PREFIX + blob.name[len(PENDING_SHARD_PREFIX):]: int((blob.metadata or {}).get("images", 0))
+        for blob in container_client.list_blobs(name_starts_with=PENDING_SHARD_PREFIX, include=["metadata"])
+        if blob.name.endswith(".tfrecord.gz")
+    }
+
+
+def trained_shards(container_client) -> dict:
+    """All shards a published model has been trained on, as {blob name: number of images}."""
+    return {
+        blob.name: int((blob.metadata or {}).get("images", 0))
+        for blob in container_client.list_blobs(name_starts_with=FEEDBACK_SHARD_PREFIX, include=["metadata"])
+        if blob.name.endswith(".tfrecord.gz") and "trained_version" in (blob.metadata or {})
+    }
+
+
+def history_shards(container_client, n_shards: int = FEEDBACK_HISTORY_SHARDS) -> dict:
+    """Randomly sample up to n_shards already trained shards, returns {blob name: number of images}."""
+    if n_shards <= 0:
+        return {}
+    shards = trained_shards(container_client)
+    sample = random.sample(sorted(shards), min(n_shards, len(shards)))
+    return {blob_name: shards[blob_name] for blob_name in sample}
+
+
+def mark_trained(container_client, shards: dict, version: int):
+    """Record that a published model version has been trained on the shards and drop their markers."""
+    for blob_name, n_images in shards.items():
+        container_client.get_blob_client(blob_name).set_blob_metadata(
+            {"images": str(n_images), "trained_version": str(version)}
+        )
+        try:
+            container_client.delete_blob(pending_marker(blob_name))
+        except ResourceNotFoundError:
+            pass
+
+
+def fetch_shards(container_client, blob_names: list) -> list:
+    """
+    Download the shards that are not cached locally yet, in parallel. With
+    the local storage backend the shards are read from their own files.
+    """
+    os.makedirs(SHARD_CACHE_DIR, exist_ok=True)
+
+    def fetch(blob_name):
+        if (path := blob_path(blob_name)) is not None:
+            return path
+        path = local_path(blob_name)
+        if not os.path.exists(path):
+            with open(path + ".tmp", "wb") as f:
+                downloader = container_client.get_blob_client(blob_name).download_blob(max_concurrency=TRANSFER_CONCURRENCY)
+                count_transfer("downloaded", downloader.readinto(f))
+            os.replace(path + ".tmp", path)
+        return path
+
+    with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as pool:
+        return list(pool.map(with_transfer_counters(fetch), blob_names))
+
+
+def parse_example(record):
+    example = tf.io.parse_single_example(record, FEATURES)
+    image = tf.reshape(tf.io.decode_raw(example["image"], tf.uint8), (IMAGE_RES, IMAGE_RES, 3))
+    return image, tf.cast(example["label"], tf.int32)
+
+
+def shard_images(paths: list):
+    """Unbatched (uint8 image, label) pairs read from several shards at once."""
+    dataset = tf.data.Dataset.from_tensor_slices(paths).shuffle(len(paths))
+    dataset = dataset.interleave(
+        lambda path: tf.data.TFRecordDataset(path, compression_type="GZIP"),
+        cycle_length=min(len(paths), INGEST_WORKERS),
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=False,
+    )
+    return dataset.map(parse_example, num_parallel_calls=tf.data.AUTOTUNE)
+
+
+def feedback_dataset(paths: list):
+    """
+    Training batches over the given local shards, normalized like the
+    validation images. The shards are read in parallel and shuffled, and
+    only SHUFFLE_BUFFER images and PREFETCH_BATCHES batches are in memory.
+    """
+    dataset = shard_images(paths).shuffle(SHUFFLE_BUFFER, reshuffle_each_iteration=True)
+    dataset = dataset.map(lambda image, label: (tf.cast(image, tf.float32) / 255.0, label),
+                          num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.batch(TRAIN_BATCH_SIZE).prefetch(PREFETCH_BATCHES)
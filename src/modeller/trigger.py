@@ -0,0 +1,92 @@
+import os
+import time
+import logging
+
+from datetime import datetime, timezone
+
+# Retrain when at least this many labelled images are waiting
+RETRAIN_MIN_IMAGES = int(os.environ.get("RETRAIN_MIN_IMAGES", "5"))
+# ...or when the oldest waiting image has waited this long (0 disables)
+RETRAIN_MAX_AGE_SECONDS = float(os.environ.get("RETRAIN_MAX_AGE_SECONDS", "600"))
+# Queue polling interval, doubled on every idle poll up to the maximum
+POLL_MIN_SECONDS = float(os.environ.get("POLL_MIN_SECONDS", "1"))
+POLL_MAX_SECONDS = float(os.environ.get("POLL_MAX_SECONDS", "60"))
+
+
+class RetrainTrigger:
+    """
+    Decides when to retrain by watching the feedback queue.
+
+    The queue is polled with one long-lived queue client. While new messages
+    keep arriving the polling interval stays at POLL_MIN_SECONDS; every poll
+    without changes doubles it up to POLL_MAX_SECONDS, so an idle queue costs
+    only a handful of storage calls per hour.
+    """
+
+    def __init__(self, queue_client, min_images: int = RETRAIN_MIN_IMAGES,
+                 max_age_seconds: float = RETRAIN_MAX_AGE_SECONDS,
+                 min_interval: float = POLL_MIN_SECONDS, max_interval: float = POLL_MAX_SECONDS):
+        self.queue_client = queue_client
+        self.min_images = min_images
+        self.max_age_seconds = max_age_seconds
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    def n_images_waiting(self) -> int:
+        """
+        Messages in the queue, including the ones hidden because another
+        modeller has claimed them or a crashed one left them invisible.
+        """
+        properties = self.queue_client.get_queue_properties()
+        return properties.approximate_message_count
+
+    def any_visible(self) -> bool:
+        return len(self.queue_client.peek_messages(max_messages=1)) > 0
+
+    def oldest_age(self) -> float:
+        """Seconds the oldest visible message has been in the queue (0 if none)."""
+        messages = self.queue_client.peek_messages(max_messages=1)
+        if not messages:
+            return 0.0
+        return (datetime.now(timezone.utc) - messages[0].inserted_on).total_seconds()
+
+    def wait(self, pending=None) -> int:
+        """
+        Block until a retrain should start and return the number of waiting images.
+        pending() can return the number of images that were already ingested
+        but not trained on yet. They passed the thresholds when they were
+        ingested, so any pending images start a retrain right away.
+        """
+        interval = self.min_interval
+        last_count = None
+        while True:
+            n_pending = pending() if pending is not None else 0
+            if n_pending > 0:
+                logging.info(f"{n_pending} ingested images waiting, starting retraining.")
+                return n_pending
+
+            n_images = self.n_images_waiting()
+            # Hidden messages cannot be received, waking up for them would only spin
+            if n_images >= self.min_images and self.any_visible():
+                logging.info(f"{n_images} labeled images waiting, starting retraining.")
+                return n_images
+
+            sleep_for = interval
+            if n_images > 0 and self.max_age_seconds > 0:
+                age = self.oldest_age()
+                if age >= self.max_age_seconds:
+                    logging.info(f"Oldest of {n_images} images has waited {age:.0f} s, starting retraining.")
+                    return n_images
+                # Wake up in time for the age limit
+                sleep_for = min(sleep_for, self.max_age_seconds - age)
+
+            # Poll quickly while feedback is arriving, back off while the queue is idle
+            if n_images != last_count:
+                logging.info(f"Labeled images waiting in queue: {n_images}")
+                interval = self.min_interval
+                sleep_for = min(sleep_for, interval)
+            else:
+                interval = min(interval * 2, self.max_interval)
+            last_count = n_images
+
+            time.sleep(max(sleep_for, self.min_interval))
@@ -1,180 +1,412 @@
 import os
 import logging
-import zlib
 import numpy as np
-import pandas as pd
-import pathlib
 import zipfile
 import json
+import hashlib
+import tempfile
 from datetime import datetime
 
-from base64 import b64decode
-from io import BytesIO, StringIO
-from PIL import Image
-from azure.storage.blob import BlobServiceClient
-from azure.storage.queue import QueueServiceClient
-from sklearn.linear_model import LogisticRegression
+from azure.core import MatchConditions
+from azure.core.exceptions import HttpResponseError, ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
 import tensorflow as tf
-from tensorflow.keras import preprocessing
-from functools import lru_cache
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-# Are we running in the cloud?
-CLOUD = os.environ.get("USE_AZURE_CREDENTIAL", "false").lower() == "true"
+# Shared, pooled storage clients (src/common/storage.py)
+from storage import (
+    TRANSFER_CONCURRENCY, count_transfer, with_transfer_counters, get_container_client,
+    download_to_file, upload_file, upload_bytes, blob_path,
+)
 
-def get_blob_service_client():
+# Small blob that always points to the newest model
+MANIFEST_BLOB = "models/latest.json"
+
+# Threads used to download feedback images
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", "8"))
+# How long received messages stay hidden from other readers, extended while they are ingested
+INGEST_VISIBILITY_TIMEOUT = int(os.environ.get("INGEST_VISIBILITY_TIMEOUT", "300"))
+# Maximum number of messages used for one retrain, 0 means the whole queue
+INGEST_MAX_MESSAGES = int(os.environ.get("INGEST_MAX_MESSAGES", "0"))
+
+IMAGE_RES = 224
+FLOWER_LIST = ['dandelion', 'daisy', 'tulips', 'sunflowers', 'roses']
+
+# Preprocessed validation set on local disk
+VAL_CACHE_DIR = os.environ.get("VAL_CACHE_DIR", "./val_cache")
+VAL_IMAGES = os.path.join(VAL_CACHE_DIR, "images.npy")
+VAL_LABELS = os.path.join(VAL_CACHE_DIR, "labels.npy")
+
+# Training pipeline sizes
+TRAIN_BATCH_SIZE = int(os.environ.get("TRAIN_BATCH_SIZE", "32"))
+SHUFFLE_BUFFER = int(os.environ.get("SHUFFLE_BUFFER", "1024"))
+PREFETCH_BATCHES = int(os.environ.get("PREFETCH_BATCHES", "2"))
+
+# Function to read the model manifest
+def read_manifest() -> dict | None:
     """
-    The STORAGE_CONNECTION_STRING is only set up when running in the cloud. 
-    If it's not set, we're running locally with Azurite.
+    Read the manifest that points to the latest model.
+    Returns None if no manifest has been published yet.
     """
-    if CLOUD:
-        from azure.identity import DefaultAzureCredential # type: ignore
-        credential = DefaultAzureCredential()
-        account_url = os.environ["STORAGE_BLOB_URL"]
-        return BlobServiceClient(account_url=account_url, credential=credential)
-    else:
-        return BlobServiceClient.from_connection_string(os.environ["STORAGE_CONNECTION_STRING"])
-    
-def get_queue_service_client():
-    """
-    The STORAGE_CONNECTION_STRING is only set up when running in the cloud. 
-    If it's not set, we're running locally with Azurite.
-    """
-    if CLOUD:
-        from azure.identity import DefaultAzureCredential # type: ignore
-        credential = DefaultAzureCredential()
-        account_url = os.environ["STORAGE_QUEUE_URL"]
-        return QueueServiceClient(account_url=account_url, credential=credential)
-    else:
-        return QueueServiceClient.from_connection_string(os.environ["STORAGE_CONNECTION_STRING"])
-    
+    blob_client = get_container_client().get_blob_client(MANIFEST_BLOB)
+    try:
+        return json.loads(blob_client.download_blob().readall())
+    except ResourceNotFoundError:
+        return None
+
 
-# Check how many messages are in the queue
-def n_images_waiting() -> int:
-    with get_queue_service_client() as queue_client:
-        queue = queue_client.get_queue_client(os.environ["STORAGE_QUEUE"])
-        queue_properties = queue.get_queue_properties()
-        message_count = queue_properties.approximate_message_count
-        logging.info(f"Labeled images waiting in queue: {message_count}")
-        return message_count
+class StaleModelError(Exception):
+    """The manifest already points to the same or a newer model version."""
+
+
+# Function to publish a new model version in the manifest
+def publish_manifest(version: int, blob_name: str, etag: str, size: int, tflite: dict | None = None,
+                     delta: dict | None = None):
+    """
+    blob_name is the full .keras model. If delta is given, the version is
+    that model with the weights in the delta blob applied on top.
+    The manifest only moves forward: it is replaced only if it points to an
+    older version and has not changed since it was checked, so a modeller
+    that lost the leader role during a slow upload cannot publish over a
+    newer model. Raises StaleModelError otherwise.
+    """
+    blob_client = get_container_client().get_blob_client(MANIFEST_BLOB)
+    try:
+        downloader = blob_client.download_blob()
+        current, current_etag = json.loads(downloader.readall()), downloader.properties.etag
+    except ResourceNotFoundError:
+        current, current_etag = None, None
+    if current is not None and int(current["version"]) >= version:
+        raise StaleModelError(f"{MANIFEST_BLOB} already points to version {current['version']}, not publishing {version}.")
+
+    manifest = {
+        "version": version,
+        "blob_name": blob_name,
+        "etag": etag,
+        "size": size,
+        "published_at": datetime.now().isoformat(),
+    }
+    # Optional quantized serving artifact
+    if tflite is not None:
+        manifest["tflite"] = tflite
+    if delta is not None:
+        manifest["delta"] = delta
+    if current_etag is None:
+        condition = {"overwrite": False}
+    else:
+        condition = {"etag": current_etag, "match_condition": MatchConditions.IfNotModified}
+    try:
+        upload_bytes(MANIFEST_BLOB, json.dumps(manifest).encode(), content_type="application/json", **condition)
+    except (ResourceExistsError, ResourceModifiedError):
+        raise StaleModelError(f"{MANIFEST_BLOB} was changed by another modeller, not publishing {version}.")
+    logging.info(f"Published model version {version} in {MANIFEST_BLOB}.")
 
 
 # Function to check latest model version
-def latest_model_version() -> int:
+def latest_model_version(manifest: dict | None) -> int:
+    """
+    Retrieve the latest model version from a manifest returned by read_manifest().
+    Older deployments without a manifest fall back to the Unix timestamp in
+    the model file names. If no Unix-formatted models are found, default to
+    'flowers_1.keras'.
+    """
+    if manifest is not None:
+        return int(manifest["version"])
+    return list_model_versions()
+
+
+def list_model_versions() -> int:
     """
     Retrieve the latest model version based on the Unix timestamp in the model file name.
-    If no Unix-formatted models are found, default to 'flowers_1.keras'.
-    """
-    with get_blob_service_client() as blob_service_client:
-        container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
-        blobs = container_client.list_blobs(name_starts_with="models/")
-
-        model_versions = []
-
-        for blob in blobs:
-            try:
-                # Attempt to extract the Unix timestamp from the model name
-                version = int(blob.name.split("_")[1].split(".")[0])
-                model_versions.append(version)
-            except (IndexError, ValueError):
-                logging.warning(f"Skipping non-standard model name: {blob.name}")
-
-        if model_versions:
-            latest = max(model_versions)
-            unix_to_iso = datetime.fromtimestamp(latest).isoformat()
-            logging.info(f"latest_model_version() seeing: {latest} created at {unix_to_iso}")
-            return latest
-        else:
-            # Fallback to default model name
-            logging.info("No Unix-formatted model found, defaulting to flowers_1.keras")
-            return 1
+    """
+    container_client = get_container_client()
+    blobs = container_client.list_blobs(name_starts_with="models/")
+
+    model_versions = []
+
+    for blob in blobs:
+        if not blob.name.endswith(".keras"):
+            continue
+        try:
+            # Attempt to extract the Unix timestamp from the model name
+            version = int(blob.name.split("_")[1].split(".")[0])
+            model_versions.append(version)
+        except (IndexError, ValueError):
+            logging.warning(f"Skipping non-standard model name: {blob.name}")
+
+    if model_versions:
+        latest = max(model_versions)
+        unix_to_iso = datetime.fromtimestamp(latest).isoformat()
+        logging.info(f"latest_model_version() seeing: {latest} created at {unix_to_iso}")
+        return latest
+    else:
+        # Fallback to default model name
+        logging.info("No Unix-formatted model found, defaulting to flowers_1.keras")
+        return 1
 
 # Function to load the wanted model version
-@lru_cache(maxsize=5)
 def load_model(version:int):
-    with get_blob_service_client() as blob_service_client:
-        container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
-        blob_client = container_client.get_blob_client(f"models/flowers_{version}.keras")
-        logging.info(f"Loading model version {version}.")
-        # Download the blob content into memory
-        blob_data = blob_client.download_blob()
-        # If it's a binary file, you can read it directly as bytes
-        file_bytes = blob_data.readall()
-        return file_bytes
-
-
-def load_valdata():
-    with get_blob_service_client() as blob_service_client:
-        container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
-        blob_client = container_client.get_blob_client("datasets/val_data.zip")
-
-        os.makedirs('./val/', exist_ok=True)
-        target_folder = pathlib.Path('./val/')
-        blob_stream = blob_client.download_blob()
-        zip_data = blob_stream.readall() # Get the entire blob content as bytes
-
-        # Open the zip file from the in-memory bytes and extract it
-        with zipfile.ZipFile(BytesIO(zip_data), mode="r") as archive:
-            print(f"Extracting contents to {target_folder}...")
-            archive.extractall(target_folder)
-            print("Extraction complete!")
+    """
+    Download a model version and deserialize it. Keras can only load
+    .keras files from disk, so the blob is streamed to a temporary file
+    that is removed right after loading. With the local storage backend
+    the model is loaded from its own file.
+    """
+    logging.info(f"Loading model version {version}.")
+    if (path := blob_path(f"models/flowers_{version}.keras")) is not None:
+        return tf.keras.models.load_model(path)
+    with tempfile.NamedTemporaryFile(delete=False, suffix=".keras") as temp_file:
+        download_to_file(f"models/flowers_{version}.keras", temp_file)
+        temp_file_path = temp_file.name
+    try:
+        return tf.keras.models.load_model(temp_file_path)
+    finally:
+        os.remove(temp_file_path)
 
-        return None
 
+def load_valdata() -> dict:
+    """
+    Make sure the preprocessed validation set in VAL_CACHE_DIR matches
+    datasets/val_data.zip in the storage container.
+
+    The zip is only downloaded if its ETag differs from the one the cache
+    was built from. It is streamed to a temporary file, checked against the
+    blob's Content-MD5 when the storage provides one, and decoded once into
+    uint8 (N, 224, 224, 3) images and int32 labels saved as .npy files.
+    The labels follow FLOWER_LIST, the same order as in the model.
+    """
+    os.makedirs(VAL_CACHE_DIR, exist_ok=True)
+    meta_path = os.path.join(VAL_CACHE_DIR, "meta.json")
+
+    blob_client = get_container_client().get_blob_client("datasets/val_data.zip")
+    properties = blob_client.get_blob_properties()
+
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        if meta.get("etag") == properties.etag:
+            logging.info(f"Validation cache is up to date ({meta['n_images']} images).")
+            return meta
+
+    # The local storage backend has the zip on disk already
+    if (path := blob_path("datasets/val_data.zip")) is not None:
+        with open(path, "rb") as zip_file:
+            meta = preprocess_valdata(zip_file, properties.etag)
+    else:
+        logging.info("Downloading datasets/val_data.zip.")
+        with tempfile.TemporaryFile() as zip_file:
+            digest = hashlib.md5()
+            downloader = blob_client.download_blob(max_concurrency=TRANSFER_CONCURRENCY)
+            for chunk in downloader.chunks():
+                count_transfer("downloaded", len(chunk))
+                digest.update(chunk)
+                zip_file.write(chunk)
+
+            expected_md5 = properties.content_settings.content_md5
+            if expected_md5 and bytes(expected_md5) != digest.digest():
+                raise ValueError("datasets/val_data.zip does not match its Content-MD5")
+
+            zip_file.seek(0)
+            meta = preprocess_valdata(zip_file, properties.etag)
+
+    # The metadata is written last, so an interrupted build is redone next time
+    with open(meta_path, "w") as f:
+        json.dump(meta, f)
+    return meta
+
+
+def preprocess_valdata(zip_file, etag: str) -> dict:
+    # Decode every image in the zip once, in the same way as the training images
+    with zipfile.ZipFile(zip_file, mode="r") as archive:
+        members = []
+        for name in sorted(archive.namelist()):
+            class_name = name.split("/")[0]
+            if name.lower().endswith((".jpg", ".jpeg", ".png")) and class_name in FLOWER_LIST:
+                members.append((name, FLOWER_LIST.index(class_name)))
+
+        images = np.lib.format.open_memmap(
+            VAL_IMAGES + ".tmp.npy", mode="w+", dtype=np.uint8, shape=(len(members), IMAGE_RES, IMAGE_RES, 3)
+        )
+        labels = np.array([label for _, label in members], dtype=np.int32)
+        for i, (name, label) in enumerate(members):
+            image, _ = decode_train_image(archive.read(name), label)
+            images[i] = np.clip(np.round(image.numpy() * 255.0), 0, 255).astype(np.uint8)
+        images.flush()
+        del images
+
+    os.replace(VAL_IMAGES + ".tmp.npy", VAL_IMAGES)
+    np.save(VAL_LABELS, labels)
+    logging.info(f"Preprocessed {len(members)} validation images into {VAL_CACHE_DIR}.")
+    return {"etag": etag, "n_images": len(members)}
+
+
+def val_dataset(batch_size: int = 32):
+    """
+    Validation batches read from the memory-mapped cache, normalized like
+    the training images.
+    """
+    images = np.load(VAL_IMAGES, mmap_mode="r")
+    labels = np.load(VAL_LABELS)
+
+    def batches():
+        for start in range(0, len(labels), batch_size):
+            yield np.asarray(images[start:start + batch_size]), labels[start:start + batch_size]
+
+    dataset = tf.data.Dataset.from_generator(
+        batches,
+        output_signature=(
+            tf.TensorSpec(shape=(None, IMAGE_RES, IMAGE_RES, 3), dtype=tf.uint8),
+            tf.TensorSpec(shape=(None,), dtype=tf.int32),
+        ),
+    )
+    return dataset.map(lambda image, label: (tf.cast(image, tf.float32) / 255.0, label)).prefetch(tf.data.AUTOTUNE)
+
+
+# Function to parse one feedback message
+def read_message(msg) -> tuple[str, int] | None:
+    """Return the (blob_name, label) of a feedback message, or None if it is malformed."""
+    # Broken feedback is acknowledged too, so it does not come back forever
+    try:
+        message_content = json.loads(msg.content)
+        blob_name = message_content["blob_name"]
+        label = int(message_content["label"])
+    except (ValueError, TypeError, KeyError, AttributeError) as e:
+        logging.warning(f"Skipping malformed message {msg.id}: {e!r}")
+        return None
+    logging.debug(f"Message {msg.id}: {blob_name} as {label}")
+    if not blob_name or not isinstance(blob_name, str):
+        logging.warning(f"Skipping malformed message {msg.id}: no blob name.")
+        return None
+    return blob_name, label
 
-# Function to resize training images
-def format_image(image):
-    IMAGE_RES = 224
-    image = tf.image.resize(image, (IMAGE_RES, IMAGE_RES))
-    return image
 
 # Function to read training data from queue and blob storage
-def get_all_from_queue() -> list[tuple[Image.Image, int]]:
-    # Get all images from the queue
+def get_all_from_queue(queue_client, max_messages: int = INGEST_MAX_MESSAGES) -> tuple[list[tuple[str, int]], list]:
+    """
+    Page through the whole queue (or max_messages messages) and return the
+    (blob_name, label) records plus the receipts for acknowledge(). The
+    images themselves are downloaded later by write_feedback_shards(), so memory
+    does not grow with the size of the backlog.
+
+    Nothing is deleted here. The messages stay invisible for
+    INGEST_VISIBILITY_TIMEOUT seconds, which MessageKeeper extends while
+    they are ingested, and acknowledge() deletes them together with the
+    blobs once the images are stored in the feedback shards. If the
+    modeller fails before that, the messages reappear for another modeller.
+    """
     logging.info("Getting all images from the queue.")
+    messages = queue_client.receive_messages(
+        messages_per_page=32,
+        visibility_timeout=INGEST_VISIBILITY_TIMEOUT,
+        max_messages=max_messages or None,
+    )
+
+    records, receipts = [], []
+    for msg in messages:
+        record = read_message(msg)
+        receipts.append((msg, record[0] if record else None))
+        if record is not None:
+            records.append(record)
+
+    logging.info(f"Got {len(records)} images from the queue.")
+    return records, receipts
+
+
+# Iterator that downloads the feedback images concurrently, in order
+def iter_feedback_images(container_client, records: list, failed: set | None = None):
+    """
+    Yield (jpeg bytes, label) for the records. INGEST_WORKERS downloads run
+    at the same time and at most twice that many images are held in memory.
+    Blobs that could not be downloaded because of a transient error are added
+    to failed, so their messages are not acknowledged and come back later.
+    Missing blobs are skipped for good.
+    """
+    def download(blob_name):
+        try:
+            data = container_client.get_blob_client(blob_name).download_blob().readall()
+            count_transfer("downloaded", len(data))
+            return data
+        except ResourceNotFoundError:
+            logging.warning(f"{blob_name} does not exist, dropping its feedback.")
+            return None
+        except Exception:
+            logging.exception(f"Could not download {blob_name}, leaving it in the queue.")
+            if failed is not None:
+                failed.add(blob_name)
+            return None
+
+    # Captured here, the generator body first runs on whichever thread pulls from it, e.g. inside tf.data
+    download = with_transfer_counters(download)
+
+    def generate():
+        window = INGEST_WORKERS * 2
+        with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as pool:
+            pending = deque()
+            for blob_name, label in records:
+                pending.append((pool.submit(download, blob_name), label))
+                if len(pending) >= window:
+                    future, label = pending.popleft()
+                    if (data := future.result()) is not None:
+                        yield data, label
+            while pending:
+                future, label = pending.popleft()
+                if (data := future.result()) is not None:
+                    yield data, label
+    return generate()
+
+
+# Image preprocessing for training, same normalization as in flowerpredict
+def decode_train_image(image_bytes, label):
+    image = tf.io.decode_image(image_bytes, channels=3, expand_animations=False)
+    image = tf.image.resize(image, (IMAGE_RES, IMAGE_RES))/255.0
+    return image, label
+
+
+# Function to delete processed feedback from the queue and blob storage
+def acknowledge(queue_client, container_client, receipts: list, skip: set = frozenset()):
+    """
+    Delete the blobs in batches of 256 and the messages concurrently.
+    Call this only after the images have been written to the feedback shards.
+    Receipts of the blobs in skip are left alone, their messages become
+    visible again after the visibility timeout.
+    """
+    if skip:
+        logging.info(f"Leaving {len(skip)} messages with failed downloads in the queue.")
+        receipts = [receipt for receipt in receipts if receipt[1] not in skip]
+    blob_names = [blob_name for _, blob_name in receipts if blob_name]
+    for start in range(0, len(blob_names), 256):
+        chunk = blob_names[start:start + 256]
+        try:
+            container_client.delete_blobs(*chunk)
+        except Exception:
+            # Fall back to single deletes if the batch API is not available
+            logging.warning("Batch delete failed, deleting blobs one by one.")
+            for blob_name in chunk:
+                try:
+                    container_client.delete_blob(blob_name)
+                except ResourceNotFoundError:
+                    pass
+
+    def delete(message):
+        try:
+            queue_client.delete_message(message)
+        except ResourceNotFoundError:
+            logging.warning(f"Message {message.id} was already deleted or its pop receipt is stale.")
+        except HttpResponseError:
+            logging.exception(f"Could not delete message {message.id}, it will be delivered again.")
+
+    with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as pool:
+        list(pool.map(lambda receipt: delete(receipt[0]), receipts))
+    logging.info(f"Acknowledged {len(receipts)} messages.")
 
-    with get_queue_service_client() as queue_service_client:
-        queue = queue_service_client.get_queue_client(os.environ["STORAGE_QUEUE"])
-        messages = queue.receive_messages(messages_per_page=32)
-        new_rows = []
-
-        for msg in messages:
-            # Get info from the queue message
-            message_content = json.loads(msg.content)
-            blob_name = message_content.get("blob_name")
-            label = message_content.get("label")
-
-            logging.info(f"Processing message: {msg.id}")
-            logging.info(f"Message name: {blob_name}")
-            logging.info(f"Message label: {label}")
-
-            # Download corresponding image from blob storage
-            with get_blob_service_client() as blob_service_client:
-                container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
-                blob_client = container_client.get_blob_client(blob_name)
-
-                blob_data = blob_client.download_blob()
-                # If it's a binary file, you can read it directly as bytes
-                file_bytes = blob_data.readall()
-                image = preprocessing.image.load_img(BytesIO(file_bytes))
-                image = format_image(image)
-
-                # Delete the blob after downloading
-                blob_client.delete_blob()
-        
-            # Add [image, label] pair to training data list
-            new_rows.append((image, label))
-            # Delete message from the queue
-            queue.delete_message(msg)
-
-    logging.info(f"Got {len(new_rows)} images from the queue. ")
-    return new_rows
 
 # Function to upload new model to the storage container
-def upload(model_file, file_path:str):
+def upload(model_file, file_path:str) -> dict:
+    """
+    Upload a file and return the blob properties from the upload (etag etc.).
+    Files larger than the storage block size are uploaded as blocks in parallel.
+    """
     logging.info("Uploading model to the storage container")
-    with get_blob_service_client() as blob_service_client:
-        container_client = blob_service_client.get_container_client(os.environ["STORAGE_CONTAINER"])
-        with open(model_file, "rb") as data:
-            blob_client = container_client.get_blob_client(file_path)
-            blob_client.upload_blob(data, overwrite=True)
-            logging.info(f"Upload complete for {model_file}.")
+    result = upload_file(file_path, model_file)
+    logging.info(f"Upload complete for {model_file}.")
+    return result